@@ -1,10 +1,12 @@
+import hmac
+
 import dash
 import dash_bootstrap_components as dbc
 import flask
 from dash import html
 
 import layout
-from settings import env
+from settings import background, cache, client, corp_data, env
 
 server = flask.Flask(__name__)
 
@@ -14,6 +16,7 @@ app = dash.Dash(
     pages_folder="pages",
     server=server,
     suppress_callback_exceptions=True,
+    background_callback_manager=background,
     assets_ignore=".*ignore.*",
     assets_folder="assets",
     external_stylesheets=[
@@ -27,6 +30,54 @@ app = dash.Dash(
 app.layout = html.Div([layout.sidebar(), layout.content])
 
 
+@server.route("/healthz")
+def healthz():
+    """Liveness probe: the worker is running."""
+    return {"status": "ok"}
+
+
+@server.route("/readyz")
+def readyz():
+    """Readiness probe: ready once any corpus can be queried (with progress)."""
+    progress = corp_data.progress()
+    progress["complete"] = progress["ready"] == progress["total"]
+    return progress, 200 if progress["ready"] else 503
+
+
+def _check_admin_token():
+    token = flask.request.headers.get("Authorization", "").removeprefix("Bearer ")
+    if not env.ADMIN_TOKEN or not hmac.compare_digest(token, env.ADMIN_TOKEN):
+        flask.abort(404)
+
+
+@server.route("/admin/reload", methods=["POST"])
+def admin_reload():
+    """Reloads the corpora file in this worker (requires `ADMIN_TOKEN`).
+
+    Other workers apply the same changes when they next check the file.
+    """
+    _check_admin_token()
+    return corp_data.reload()
+
+
+@server.route("/admin/stats")
+def admin_stats():
+    """Returns API cache counters, rate limiter, circuit breaker and server state.
+
+    Requires `ADMIN_TOKEN`.
+
+    Request counters show how much time went to connection setup (`connect_ms`
+    of `request_ms`) and how many requests reused a pooled connection.
+    """
+    _check_admin_token()
+    return {
+        "cache": cache.stats(),
+        "limiter": client.limiter.stats(),
+        "breaker": client.breaker.stats(),
+        "backends": client.pool.stats() if client.pool else None,
+    }
+
+
 if __name__ == "__main__":
     app.run(
         host=env.HOST, port=env.PORT, debug=env.DASH_DEBUG, dev_tools_hot_reload=False
@@ -0,0 +1,131 @@
+# Copyright (c) 2023 Loryn Isaacs
+# This file is part of Quartz, licensed under GPL3+ https://github.com/engisalor/quartz
+"""Benchmark building bar charts with `go.Bar` traces against `px.bar`.
+
+Usage: `python -m benchmarks.bar_figure [n_items]` (no server needed).
+"""
+import sys
+import timeit
+
+import numpy as np
+import pandas as pd
+import plotly.express as px
+
+from components.bars import bar_figure
+
+# corpus names and colors as in `Catalog`
+NAMES = {f"corpus{c}": f"Corpus {c}" for c in range(6)}
+COLORS = {f"Corpus {c}": px.colors.qualitative.Plotly[c] for c in range(6)}
+
+
+def make_data(n_corpora: int = 3, n_stats: int = 2, n_items: int = 200):
+    """Returns synthetic data for one query like `prep_data`."""
+    corpora = [f"corpus{c}" for c in range(n_corpora)]
+    stats = ["frq", "fpm", "reltt", "rel"][:n_stats]
+    n = n_corpora * n_stats * n_items
+    return pd.DataFrame(
+        {
+            "value": np.tile(
+                [f"value{x}" for x in range(n_items)], n_corpora * n_stats
+            ),
+            "attribute": "doc.attr",
+            "arg": "query0",
+            "nicearg": "query0",
+            "corpname": np.repeat(corpora, n_stats * n_items),
+            "params": np.repeat(
+                [f'{{"corpname": "{c}", "q": "query0"}}' for c in corpora],
+                n_stats * n_items,
+            ),
+            "query": "query0",
+            "statistic": np.tile(np.repeat(stats, n_items), n_corpora),
+            "f": np.random.rand(n) * 100,
+            "sort": "rel",
+            "page": 1,
+        }
+    )
+
+
+def express(data: pd.DataFrame) -> px.bar:
+    """Building a figure as done before (without the caption annotation)."""
+    df = data.copy()
+    df["corpus"] = df["corpname"].replace(NAMES)
+    df.sort_values(["corpus", "f", "value"], inplace=True)
+    df[""] = df["f"]
+    fig = px.bar(
+        df,
+        x="value",
+        y="",
+        color="corpus",
+        color_discrete_map=COLORS,
+        barmode="group",
+        facet_col="statistic",
+        facet_col_wrap=1,
+        facet_row_spacing=0.07,
+        custom_data=["params", "attribute", "value"],
+        height=len(df["statistic"].unique()) * 150 + 150,
+        hover_data={
+            "corpus": False,
+            "corpname": False,
+            "nicearg": False,
+            "value": False,
+            "": False,
+            "f": ":.2f",
+            "statistic": False,
+        },
+        category_orders={
+            "corpname": sorted(df["corpname"].unique()),
+            "statistic": sorted(df["statistic"].unique()),
+        },
+    )
+    fig.update_layout(
+        hovermode="x unified",
+        plot_bgcolor="#ffffff",
+        margin=dict(l=0, r=0, t=20),
+        xaxis_title="",
+        xaxis={"categoryorder": "category ascending"},
+    )
+    fig.update_yaxes(matches=None)
+    fig.update_xaxes(automargin=False)
+    fig.for_each_annotation(
+        lambda a: a.update(text="stat=" + a.text.split("=")[-1], font_size=15)
+    )
+    return fig
+
+
+def _check(old, new):
+    """Asserts both figures draw the same bars, subplots and labels."""
+    assert len(old.data) == len(new.data)
+    for a, b in zip(old.data, new.data):
+        for k in ["name", "xaxis", "yaxis", "showlegend", "offsetgroup"]:
+            assert a[k] == b[k], k
+        np.testing.assert_array_equal(a.x, b.x)
+        np.testing.assert_array_equal(a.y, b.y)
+        np.testing.assert_array_equal(np.stack(a.customdata)[:, :3], b.customdata)
+    old, new = old.layout.to_plotly_json(), new.layout.to_plotly_json()
+    for k in [k for k in old if k.startswith(("xaxis", "yaxis"))]:
+        assert old[k] == new[k], k
+    for k in ["annotations", "barmode", "height", "hovermode", "legend", "margin"]:
+        assert old[k] == new[k], k
+
+
+def main(n: int = 200, number: int = 10):
+    for n_corpora, n_stats in [(1, 1), (3, 2), (6, 4)]:
+        data = make_data(n_corpora, n_stats, n)
+        old, new = express(data), bar_figure(data, NAMES, COLORS)
+        _check(old, new)
+        t_old = timeit.timeit(lambda: express(data), number=number) / number
+        t_new = (
+            timeit.timeit(lambda: bar_figure(data, NAMES, COLORS), number=number)
+            / number
+        )
+        s_old, s_new = len(old.to_json()), len(new.to_json())
+        print(
+            f"{n_corpora} corp. x {n_stats} stats x {n} items: "
+            f"{t_old * 1000:.1f} ms -> {t_new * 1000:.1f} ms ({t_old / t_new:.1f}x), "
+            f"{s_old / 1024:.0f} KB -> {s_new / 1024:.0f} KB "
+            f"({1 - s_new / s_old:.0%} smaller)"
+        )
+
+
+if __name__ == "__main__":
+    main(*[int(x) for x in sys.argv[1:2]])
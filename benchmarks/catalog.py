@@ -0,0 +1,99 @@
+# Copyright (c) 2023 Loryn Isaacs
+# This file is part of Quartz, licensed under GPL3+ https://github.com/engisalor/quartz
+"""Benchmark corpus lookups with `Catalog` against DataFrame queries.
+
+Usage: `python -m benchmarks.catalog [n_corpora]` (no server needed).
+"""
+import sys
+import timeit
+from collections import Counter
+
+import pandas as pd
+
+from utils.catalog import Catalog
+
+
+def make_corpora(n: int = 50, n_attrs: int = 12) -> tuple:
+    """Returns a synthetic corpora config and structures DataFrame."""
+    attrs = [f"doc.attr{x}" for x in range(n_attrs)]
+    dt = {
+        f"corpus{c}": {
+            "name": f"Corpus {c}",
+            "color": "#636EFA",
+            "exclude": attrs[-1:],
+            "label": {a: a.split(".")[-1] for a in attrs},
+            "comparable": attrs[: n_attrs // 2],
+        }
+        for c in range(n)
+    }
+    structures = pd.DataFrame(
+        [
+            {
+                "structure": "doc",
+                "attribute": a.split(".")[-1],
+                "size": 10,
+                "corpus": c,
+                "attr": a,
+                "comparable": a in v["comparable"],
+                "label": v["label"][a],
+                "exclude": a in v["exclude"],
+                "choropleth": False,
+            }
+            for c, v in dt.items()
+            for a in attrs
+        ]
+    )
+    return dt, structures
+
+
+def dataframe_lookups(dt: dict, structures: pd.DataFrame, corpora: list):
+    """Lookups as done with DataFrame queries and rebuilt dicts."""
+    q = "corpus in @corpora and exclude==False"
+    if len(corpora) > 1:
+        q += " and comparable==True"
+    vals = structures.query(q)
+    counts = Counter(vals["label"].to_list())
+    options = vals.apply(
+        lambda row: {"label": row["label"], "value": row["label"]}, axis=1
+    ).to_list()
+    options = [x for x in options if counts[x["label"]] == len(corpora)]
+    options = list({v["label"]: v for v in options}.values())
+    options = sorted(options, key=lambda dt: dt["label"])
+    label = options[0]["label"]
+    for corpus in corpora:
+        label_map = {v: k for k, v in dt[corpus]["label"].items()}
+        label_map[label]
+    structures.loc[
+        (structures["corpus"].isin(corpora)) & (structures["label"] == label), "attr"
+    ].to_list()
+    {k: dt[k]["name"] for k in dt.keys()}
+
+
+def catalog_lookups(catalog: Catalog, corpora: list):
+    """The same lookups with a prebuilt `Catalog`."""
+    options = [{"label": x, "value": x} for x in catalog.labels(corpora)]
+    label = options[0]["label"]
+    for corpus in corpora:
+        catalog.attr(corpus, label)
+    catalog.attrs(corpora, label)
+    catalog.names
+
+
+def main(n: int = 50, number: int = 200):
+    dt, structures = make_corpora(n)
+    corpora = list(dt)[:3]
+    t_build = timeit.timeit(lambda: Catalog(dt, structures), number=10) / 10
+    catalog = Catalog(dt, structures)
+    t_df = timeit.timeit(
+        lambda: dataframe_lookups(dt, structures, corpora), number=number
+    )
+    t_cat = timeit.timeit(lambda: catalog_lookups(catalog, corpora), number=number)
+    print(f"corpora        {n}")
+    print(f"build catalog  {t_build * 1000:.3f} ms (once per config/data change)")
+    print(f"dataframe      {t_df / number * 1000:.3f} ms per callback")
+    print(f"catalog        {t_cat / number * 1000:.3f} ms per callback")
+    print(f"speedup        {t_df / t_cat:.0f}x")
+
+
+if __name__ == "__main__":
+    main(*[int(x) for x in sys.argv[1:2]])
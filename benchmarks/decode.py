@@ -0,0 +1,78 @@
+# Copyright (c) 2023 Loryn Isaacs
+# This file is part of Quartz, licensed under GPL3+ https://github.com/engisalor/quartz
+"""Benchmark decoding Freqs responses with `decode` against `Freqs.df_from_json`.
+
+Usage: `python -m benchmarks.decode [n_items]` (no server needed).
+"""
+import json
+import random
+import sys
+import timeit
+
+import pandas as pd
+from sgex import call as _call
+
+from utils import decode
+from utils.api import cached_response
+
+
+def make_responses(n_queries: int = 3, n_corpora: int = 6, n_items: int = 2000):
+    """Returns synthetic Freqs responses (as cached) and their query labels."""
+    texts, queries = [], []
+    for q in range(n_queries):
+        for c in range(n_corpora):
+            items = [
+                {
+                    "Word": [{"n": f"value{x}"}],
+                    "frq": random.randint(1, 1000),
+                    "norm": random.randint(1000, 100000),
+                    "fpm": random.random() * 100,
+                    "reltt": random.random() * 1000,
+                    "rel": random.random() * 200,
+                }
+                for x in range(n_items)
+            ]
+            _json = {
+                "Blocks": [{"Head": [{"id": "doc.attr", "n": "attr"}], "Items": items}],
+                "Desc": [{"arg": f"query{q}", "nicearg": f"query{q}", "rel": 1.5}],
+                "request": {"corpname": f"corpus{c}", "fmaxitems": str(n_items)},
+            }
+            texts.append(json.dumps(_json, indent=2))
+            queries.append(f"query{q}")
+    return texts, queries
+
+
+def per_response(texts: list[str], queries: list[str]) -> pd.DataFrame:
+    """Decoding as done before: a frame per response, then `pd.concat`."""
+    dfs = []
+    for text, query in zip(texts, queries):
+        call = _call.Freqs({"corpname": "c", "q": "q", "fcrit": "doc.attr 0"})
+        call.response = cached_response(text)
+        df = call.df_from_json()
+        df["params"] = "{}"
+        df["query"] = query
+        dfs.append(df)
+    return pd.concat(dfs)
+
+
+def columnar(texts: list[str], queries: list[str]) -> pd.DataFrame:
+    """The same frame from `decode.freqs_frame`."""
+    return decode.freqs_frame(texts, {"params": ["{}"] * len(texts), "query": queries})
+
+
+def main(n: int = 2000, number: int = 3):
+    texts, queries = make_responses(n_items=n)
+    pd.testing.assert_frame_equal(
+        per_response(texts, queries).reset_index(drop=True), columnar(texts, queries)
+    )
+    t_old = timeit.timeit(lambda: per_response(texts, queries), number=number)
+    t_new = timeit.timeit(lambda: columnar(texts, queries), number=number)
+    print(f"responses      {len(texts)} x {n} items")
+    print(f"json parser    {decode.loads.__module__}")
+    print(f"per response   {t_old / number * 1000:.1f} ms")
+    print(f"columnar       {t_new / number * 1000:.1f} ms")
+    print(f"speedup        {t_old / t_new:.1f}x")
+
+
+if __name__ == "__main__":
+    main(*[int(x) for x in sys.argv[1:2]])
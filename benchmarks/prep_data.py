@@ -0,0 +1,105 @@
+# Copyright (c) 2023 Loryn Isaacs
+# This file is part of Quartz, licensed under GPL3+ https://github.com/engisalor/quartz
+"""Benchmark preparing figure data with `melt_rows` against `query` and `melt`.
+
+Usage: `python -m benchmarks.prep_data [n_items]` (no server needed).
+"""
+import random
+import sys
+import timeit
+
+import numpy as np
+import pandas as pd
+
+from utils.convert import melt_rows
+
+stats = ["frq", "fpm", "reltt", "rel"]
+
+
+def make_frame(n_queries: int = 3, n_corpora: int = 6, n_items: int = 5000):
+    """Returns synthetic query results like `send_requests`."""
+    n = n_queries * n_corpora * n_items
+    return pd.DataFrame(
+        {
+            "frq": np.random.randint(1, 1000, n),
+            "fpm": np.random.rand(n) * 100,
+            "reltt": np.random.rand(n) * 1000,
+            "rel": np.random.rand(n) * 200,
+            "value": [f"value{random.randrange(n_items)}" for _ in range(n)],
+            "attribute": "doc.attr",
+            "arg": np.repeat([f"query{q}" for q in range(n_queries)], n // n_queries),
+            "nicearg": "",
+            "corpname": np.tile(
+                np.repeat([f"corpus{c}" for c in range(n_corpora)], n_items),
+                n_queries,
+            ),
+            "total_fpm": 1.5,
+            "total_frq": 100,
+            "fmaxitems": str(n_items),
+            "params": "{}",
+            "query": np.repeat([f"query{q}" for q in range(n_queries)], n // n_queries),
+        }
+    )
+
+
+def query_melt(df, corpora, attrs, attribute_filter, statistics):
+    """Preparing data as done before (string queries and a melt of all stats)."""
+    query_args = ["corpname in @corpora", "attribute in @attrs"]
+    if len(attribute_filter):
+        query_args.append("value in @attribute_filter")
+    slice = df.query(" and ".join(query_args)).copy()
+    melted_slice = slice.melt(
+        id_vars=[x for x in slice.columns if x not in stats],
+        var_name="statistic",
+        value_name="f",
+    )
+    melted_slice.query("statistic in @statistics", inplace=True)
+    melted_slice.sort_values("value", inplace=True)
+    return melted_slice
+
+
+def masks_melt(df, corpora, attrs, attribute_filter, statistics):
+    """The same data from `melt_rows`."""
+    filters = {"attribute": attrs, "corpname": corpora}
+    if len(attribute_filter):
+        filters["value"] = attribute_filter
+    return melt_rows(
+        df,
+        filters,
+        id_vars=[x for x in df.columns if x not in stats],
+        value_vars=[x for x in df.columns if x in stats and x in statistics],
+        var_name="statistic",
+        value_name="f",
+        sort="value",
+    )
+
+
+def _canonical(df: pd.DataFrame) -> pd.DataFrame:
+    # `melt_rows` gives a categorical `statistic` column
+    df = df.astype({"statistic": object})
+    # ties in `value` are in any order with `sort_values` (quicksort)
+    return df.sort_values(list(df.columns), kind="stable", ignore_index=True)
+
+
+def main(n: int = 5000, number: int = 10):
+    df = make_frame(n_items=n)
+    cases = {
+        "1 stat": (["corpus0", "corpus1", "corpus2"], ["doc.attr"], [], ["rel"]),
+        "2 stats": (list(df["corpname"].unique()), ["doc.attr"], [], ["rel", "frq"]),
+        "filter": (["corpus0"], ["doc.attr"], ["value1", "value2"], stats),
+    }
+    print(f"rows           {len(df)}")
+    for name, args in cases.items():
+        pd.testing.assert_frame_equal(
+            _canonical(query_melt(df, *args)), _canonical(masks_melt(df, *args))
+        )
+        t_old = timeit.timeit(lambda: query_melt(df, *args), number=number)
+        t_new = timeit.timeit(lambda: masks_melt(df, *args), number=number)
+        print(
+            f"{name:<14} {t_old / number * 1000:.1f} ms -> "
+            f"{t_new / number * 1000:.1f} ms ({t_old / t_new:.1f}x)"
+        )
+
+
+if __name__ == "__main__":
+    main(*[int(x) for x in sys.argv[1:2]])
@@ -8,7 +8,7 @@ from dash import MATCH, Input, Output, State, callback, dash_table, dcc, html
 from dash.dash_table.Format import Format
 
 from components.aio.aio import MarkdownFileAIO
-from settings import corp_data
+from settings import corp_data, env
 
 table_props = {
     "style_table": {"max-height": 181, "max-width": 500, "overflowY": "auto"},
@@ -60,12 +60,21 @@ class CorpusDetailsAIO(html.Div):
         if aio_id is None:
             aio_id = str(uuid.uuid4())
 
+        if not corp_data.is_ready(corpus):
+            super().__init__(
+                [
+                    MarkdownFileAIO(corp_data.dt[corpus].get("md_file")),
+                    html.P("Corpus data is loading", className="lead"),
+                ]
+            )
+            return
+
         sizes = corp_data.sizes.loc[corp_data.sizes["corpus"] == corpus]
         structures = corp_data.structures.loc[corp_data.structures["corpus"] == corpus]
-        vals = corp_data.structures.query("corpus==@corpus and exclude==False")
-        options = vals.apply(
-            lambda row: {"label": row["label"], "value": row["attr"]}, axis=1
-        ).to_list()
+        options = [
+            {"label": v, "value": k}
+            for k, v in corp_data.catalog.attr_labels(corpus).items()
+        ]
         options = sorted(options, key=lambda dt: dt["label"])
 
         super().__init__(
@@ -129,8 +138,8 @@ class CorpusDetailsAIO(html.Div):
         State(ids.store(MATCH), "data"),
     )
     def generate_chart(attribute, corpus):
-        df = corp_data.ttypes.loc[corp_data.ttypes["corpus"] == corpus]
-        slice = df.query("attribute == @attribute")
+        df = corp_data.get_ttypes(corpus)
+        slice = df.query("attribute == @attribute").head(env.MAX_ITEMS)
         fig = px.pie(
             slice,
             values="frq",
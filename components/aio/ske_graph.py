@@ -1,23 +1,37 @@
 # Copyright (c) 2023 Loryn Isaacs
 # This file is part of Quartz, licensed under GPL3+ https://github.com/engisalor/quartz
 import json
-import textwrap
+import time
 import uuid
 
 import dash_bootstrap_components as dbc
 import pandas as pd
-from dash import MATCH, Input, Output, State, callback, ctx, dcc, html
-from sgex.job import Job
+from dash import ALL, MATCH, Input, Output, State, callback, ctx, dcc, html, no_update
 from sgex.query import _query_escape
 
-from components.freqs_fig import bar_figure, prep_data
-from settings import corp_data, env
-from utils import url
+from components.bars import param_table
+from components.freqs_fig import bar_caption, bar_figure, prep_data
+from settings import client, corp_data, env, store
+from utils import contingency, paging, url
+from utils.api import make_call
 
 
-def _update_link(point: dict) -> dbc.NavLink:
-    """Generates a nav link based on figure click data."""
-    ls = point.get("customdata")
+def _point_data(point: dict, call_params: list | None = None) -> tuple:
+    """Returns the params, attribute path and value of a figure click data point.
+
+    Notes:
+        Figures hold indexes into a side table of params, stored once per graph
+        (see `param_table`), instead of repeating params for each point.
+    """
+    params, attr_path, value = point.get("customdata", [None] * 3)[:3]
+    if isinstance(params, int):
+        params = call_params[params]
+    return params, attr_path, value
+
+
+def _update_link(point: dict, call_params: list | None = None) -> dbc.NavLink:
+    """Generates a nav link based on figure click data (see `_point_data`)."""
+    ls = _point_data(point, call_params)
     params = json.loads(ls[0])
     href = url.cql_ttype_filter(
         params=params,
@@ -28,7 +42,7 @@ def _update_link(point: dict) -> dbc.NavLink:
     return dbc.NavLink(
         html.I(
             className="bi bi-arrow-up-right-square-fill",
-            title="Go to " + corp_data.dt[params["corpname"]]["name"],
+            title="Go to " + corp_data.catalog.names[params["corpname"]],
             style={"color": corp_data.dt[params["corpname"]]["color"]},
         ),
         href=href,
@@ -37,48 +51,258 @@ def _update_link(point: dict) -> dbc.NavLink:
 
 
 def _params_from_point(
-    point: dict, crossfilter, crossfilter_sorting, crossfilter_page
+    point: dict,
+    crossfilter,
+    crossfilter_sorting,
+    crossfilter_page,
+    call_params: list | None = None,
 ) -> tuple:
-    """Builds API parameters from figure click data point."""
-    params, attr_path, value = point.get("customdata", [None] * 3)[:3]
+    """Builds API parameters from figure click data point (see `_point_data`)."""
+    params, attr_path, value = _point_data(point, call_params)
     params = json.loads(params)
     corpus = params["corpname"]
-    label_map = {v: k for k, v in corp_data.dt[corpus]["label"].items()}
     struct, attr = url.split_attr_path(attr_path)
     params["call_type"] = "Freqs"
     params["q"] += f' within <{struct} {attr}="{_query_escape(value)}" />'
-    params["fcrit"] = f"{label_map[crossfilter]} 0"
+    params["fcrit"] = f"{corp_data.catalog.attr(corpus, crossfilter)} 0"
     params["freq_sort"] = crossfilter_sorting
     params["fpage"] = crossfilter_page
     # also try: [f"{x} 0" for x in corp_data.dt[_params["corpname"]]["label"].keys()]
-    x_suffix = corp_data.dt[corpus]["label"][attr_path] + f"=`{value}`"
+    x_suffix = corp_data.catalog.label(corpus, attr_path) + f"=`{value}`"
     return params, x_suffix
 
 
-def _df_from_crossfilter(
-    clickdata: dict, crossfilter, title, crossfilter_sorting, crossfilter_page
+def _crossfilter_params(
+    clickdata: dict,
+    crossfilter,
+    crossfilter_sorting,
+    crossfilter_page,
+    call_params: list | None = None,
 ) -> tuple:
-    """Runs API calls based on figure click data."""
+    """Builds API parameters for all click data points (and the x-axis suffix)."""
     params = []
     for point in clickdata["points"]:
         _params, x_suffix = _params_from_point(
-            point, crossfilter, crossfilter_sorting, crossfilter_page
+            point, crossfilter, crossfilter_sorting, crossfilter_page, call_params
         )
         params.append(_params)
-    j = Job(params=params, **env.sgex)
-    j.run()
+    return params, x_suffix
+
+
+def _crossfilter_key(
+    clickdata: dict,
+    crossfilter,
+    title,
+    crossfilter_sorting,
+    crossfilter_page,
+    call_params: list | None = None,
+) -> str:
+    """Returns the result store key for a crossfilter."""
+    params, _ = _crossfilter_params(
+        clickdata, crossfilter, crossfilter_sorting, crossfilter_page, call_params
+    )
+    return store.key(params, title)
+
+
+def _progress_text(done: int, total: int) -> str:
+    return f"{done}/{total} Freqs calls done"
+
+
+def _df_from_tables(
+    clickdata: dict,
+    crossfilter,
+    crossfilter_sorting,
+    crossfilter_page,
+    progress,
+    call_params: list | None = None,
+) -> list[pd.DataFrame] | None:
+    """Slices crossfilters from attribute × crossfilter tables (see `contingency`).
+
+    Returns:
+        A frame for each unique point like `paging.fetch_pages`, or `None` if a
+        table is incomplete or statistics can't be derived (the crossfilters
+        have to be fetched one by one).
+    """
+    points = {}
+    for point in clickdata["points"]:
+        params, attr_path, value = _point_data(point, call_params)
+        points.setdefault((params, value), attr_path)
+    queries = [json.loads(p) | {"call_type": "Freqs"} for p, _ in points]
+    tables = contingency.fetch_tables(
+        client,
+        [
+            contingency.table_params(
+                q,
+                corp_data.catalog.attr(q["corpname"], crossfilter),
+                env.CROSSFILTER_TABLE,
+            )
+            for q in queries
+        ],
+        env.CROSSFILTER_TABLE,
+        progress,
+    )
+    if any(t is None for t in tables):
+        return None
+    # occurrences within each value are those of the query's results (cached)
+    frames, errors = paging.fetch_pages(
+        client, queries, env.PAGE_BLOCK, derive=corp_data.derive_stats
+    )
+    if errors:
+        return None
     dfs = []
-    for call in j.data.freqs:
-        df = call.df_from_json()
-        df["params"] = json.dumps(call.params)
-        df["query"] = title
-        dfs.append(df)
-    return pd.concat(dfs), x_suffix
+    for (params, value), table, query, frame in zip(points, tables, queries, frames):
+        point = {"customdata": [params, points[(params, value)], value]}
+        _params, _ = _params_from_point(
+            point, crossfilter, crossfilter_sorting, crossfilter_page
+        )
+        total = frame.loc[frame["value"] == value, "frq"]
+        df = contingency.cells(table, value)
+        if total.empty or df.empty:
+            dfs.append(pd.DataFrame())
+            continue
+        df["attribute"] = corp_data.catalog.attr(query["corpname"], crossfilter)
+        df["corpname"] = query["corpname"]
+        df["total_frq"] = total.iloc[0]
+        df = corp_data.derive_stats(df)
+        if df is None:
+            return None
+        size = int(query["fmaxitems"])
+        start = (int(crossfilter_page) - 1) * size
+        df = df.sort_values(crossfilter_sorting, ascending=False, kind="stable")
+        df = df.iloc[start : start + size].reset_index(drop=True)
+        df["arg"] = df["nicearg"] = _params["q"].split(",", 1)[1]
+        df["total_fpm"] = df["total_frq"] / corp_data.tokens(query["corpname"]) * 1e6
+        df["fmaxitems"] = str(size)
+        df["params"] = json.dumps(make_call(_params).params)
+        dfs.append(df[frame.columns])
+    return dfs
 
 
-def _pop_attr_annotation(annotation):
-    if annotation.text.startswith("attr"):
-        annotation.update(text="")
+def _dfs_from_crossfilters(
+    clickdatas: list[dict],
+    crossfilter,
+    titles: list,
+    crossfilter_sorting,
+    crossfilter_page,
+    progress=None,
+    call_params: list | None = None,
+) -> list[tuple]:
+    """Gets crossfilters for several graphs, sending missing calls in one `Job`.
+
+    Args:
+        call_params: The params side table of each graph (see `_point_data`).
+
+    Returns:
+        `(df, x_suffix)` for each graph (see `_df_from_crossfilter`).
+    """
+    results = []
+    pending = {}
+    call_params = call_params or [None] * len(clickdatas)
+    for x, (clickdata, title) in enumerate(zip(clickdatas, titles)):
+        params, x_suffix = _crossfilter_params(
+            clickdata,
+            crossfilter,
+            crossfilter_sorting,
+            crossfilter_page,
+            call_params[x],
+        )
+        key = store.key(params, title)
+        df = store.get(key)
+        if df is None and env.CROSSFILTER_TABLE:
+            dfs = _df_from_tables(
+                clickdata,
+                crossfilter,
+                crossfilter_sorting,
+                crossfilter_page,
+                progress,
+                call_params[x],
+            )
+            if dfs is not None:
+                for _df in dfs:
+                    _df["query"] = title
+                df = pd.concat(dfs)
+                if paging.cached_at(dfs):
+                    df.attrs["cached_at"] = paging.cached_at(dfs)
+                else:
+                    store.set(key, df)
+        if df is None:
+            pending[x] = (key, params)
+        results.append([df, x_suffix])
+    if pending:
+        graphs = [x for x, (_, _params) in pending.items() for _ in _params]
+        frame, errors = paging.fetch_frame(
+            client,
+            [p for _, _params in pending.values() for p in _params],
+            env.PAGE_BLOCK,
+            progress,
+            derive=corp_data.derive_stats,
+            columns={"query": [titles[x] for x in graphs]},
+        )
+        failed = {graphs[e[2]] for e in errors}
+        for x, df in paging.split(frame, graphs).items():
+            if "cached_at" not in df.attrs and x not in failed:
+                store.set(pending[x][0], df)
+            results[x][0] = df
+    return [tuple(x) for x in results]
+
+
+def _df_from_crossfilter(
+    clickdata: dict,
+    crossfilter,
+    title,
+    crossfilter_sorting,
+    crossfilter_page,
+    progress=None,
+    call_params: list | None = None,
+) -> tuple:
+    """Runs API calls based on figure click data (see `Client.run` for progress)."""
+    return _dfs_from_crossfilters(
+        [clickdata],
+        crossfilter,
+        [title],
+        crossfilter_sorting,
+        crossfilter_page,
+        progress,
+        [call_params],
+    )[0]
+
+
+def _cached_badge(cached_at: float) -> dbc.Badge:
+    """Shows that results are stale because the server isn't responding."""
+    date = time.strftime("%Y-%m-%d %H:%M", time.localtime(cached_at))
+    return dbc.Badge(
+        f"Server unavailable: showing results cached at {date}",
+        color="warning",
+        className="cached-badge",
+    )
+
+
+def _graph2_children(
+    id: dict, df: pd.DataFrame, x_suffix, corpora, crossfilter, statistics, sort, page
+) -> list:
+    """Returns a crossfilter graph and its link for a `Graph2_div`."""
+    if df.empty:
+        return html.P("Nothing found", className="lead")
+    children = []
+    if df.attrs.get("cached_at"):
+        children.append(_cached_badge(df.attrs["cached_at"]))
+    df = prep_data(corpora, crossfilter, [], statistics, sort, page, df)
+    params = param_table(df)
+    fig = bar_figure(df, params=params)
+    text = f"{x_suffix} {bar_caption(df)}"
+    return children + [
+        html.Div(
+            html.I(
+                className="bi bi-arrow-up-right-square-fill",
+                title="No data point selected",
+            ),
+            id=id | {"type": "Link2"},
+            className="link-div",
+        ),
+        dcc.Markdown(text),
+        dcc.Store(data=params, id=id | {"type": "Params2"}),
+        dcc.Graph(figure=fig, id=id | {"type": "Graph2"}),
+    ]
 
 
 class SkeGraphAIO(html.Div):
@@ -111,6 +335,14 @@ class SkeGraphAIO(html.Div):
             "type": "Graph2_div",
             "group": aio_id,
         }
+        params1 = lambda aio_id: {  # noqa: E731
+            "type": "Params1",
+            "group": aio_id,
+        }
+        params2 = lambda aio_id: {  # noqa: E731
+            "type": "Params2",
+            "group": aio_id,
+        }
 
     ids = ids
 
@@ -118,6 +350,8 @@ class SkeGraphAIO(html.Div):
         self,
         title: str,
         aio_id=None,
+        caption: str = "",
+        params: list | None = None,
         **kwargs,
     ):
         if aio_id is None:
@@ -131,13 +365,6 @@ class SkeGraphAIO(html.Div):
             className="title-div",
         )
 
-        text = ""
-        for annotation in kwargs["figure"].layout.annotations:
-            if annotation.text.startswith("attr"):
-                text += annotation.text
-        text = "<br>".join(textwrap.wrap(text, 80))
-        kwargs["figure"].for_each_annotation(_pop_attr_annotation)
-
         graph1_div = html.Div(
             children=[
                 html.Div(
@@ -148,7 +375,8 @@ class SkeGraphAIO(html.Div):
                     id=self.ids.link1(aio_id),
                     className="link-div",
                 ),
-                dcc.Markdown(text),
+                dcc.Markdown(caption),
+                dcc.Store(id=self.ids.params1(aio_id), data=params),
                 dcc.Graph(id=self.ids.graph1(aio_id), **kwargs),
             ],
             id=self.ids.graph1_div(aio_id),
@@ -173,82 +401,100 @@ class SkeGraphAIO(html.Div):
     @callback(
         Output(ids.link1(MATCH), "children"),
         Input(ids.graph1(MATCH), "clickData"),
+        State(ids.params1(MATCH), "data"),
         prevent_initial_call=True,
     )
-    def update_link1(clickData):
+    def update_link1(clickData, params):
         if clickData:
-            _links1 = [_update_link(point) for point in clickData["points"]]
+            _links1 = [_update_link(point, params) for point in clickData["points"]]
             return sorted(_links1, key=lambda nav: nav.href)
 
     @callback(
         Output(ids.link2(MATCH), "children"),
         Input(ids.graph2(MATCH), "clickData"),
+        State(ids.params2(MATCH), "data"),
         prevent_initial_call=True,
     )
-    def update_link(clickData):
+    def update_link(clickData, params):
         if clickData:
-            _links1 = [_update_link(point) for point in clickData["points"]]
+            _links1 = [_update_link(point, params) for point in clickData["points"]]
             return sorted(_links1, key=lambda nav: nav.href)
 
     @callback(
-        Output(ids.graph2_div(MATCH), "children"),
-        Input(ids.graph1(MATCH), "clickData"),
+        Output(ids.graph2_div(ALL), "children"),
+        Input(ids.graph1(ALL), "clickData"),
         Input("crossfilter-picker", "value"),
-        Input(ids.title(MATCH), "data"),
+        Input(ids.title(ALL), "data"),
         Input("crossfilter-sort-picker", "value"),
         Input("crossfilter-page-picker", "value"),
         State("corpora-picker", "value"),
         State("attribute-picker", "value"),
         State("statistic-picker", "value"),
         State("sort-picker", "value"),
+        State(ids.params1(ALL), "data"),
+        background=True,
+        # background callbacks don't support pattern-matching progress outputs
+        progress=Output("crossfilter-progress", "children"),
+        progress_default=None,
+        running=[(Output("query-cancel-button", "disabled"), False, True)],
+        cancel=[Input("query-cancel-button", "n_clicks")],
     )
     def make_graph2(
-        clickdata,
+        set_progress,
+        clickdatas,
         crossfilter,
-        title,
+        titles,
         crossfilter_sorting,
         crossfilter_page,
         corpora,
         attribute,
         statistics,
         sort,
+        params,
     ):
-        id = ctx.outputs_list["id"] | {"type": "Graph2"}
-        if not crossfilter:
-            return html.P("Crossfilter disabled", className="lead")
-        if not clickdata:
-            return html.P("Select a data point to crossfilter", className="lead")
-
-        df, x_suffix = _df_from_crossfilter(
-            clickdata, crossfilter, title, crossfilter_sorting, crossfilter_page
-        )
-        if df.empty:
-            return html.P("Nothing found", className="lead")
+        """Draws crossfilters for all graphs at once (one `Job` for their calls).
 
-        df = prep_data(
-            corpora,
+        Notes:
+            A click redraws every graph with a selected data point, since a new
+            job cancels the previous one (graphs already drawn are store hits);
+            changing a crossfilter option redraws them all.
+        """
+        groups = [x["id"]["group"] for x in ctx.outputs_list]
+        clickdatas = {x["id"]["group"]: x.get("value") for x in ctx.inputs_list[0]}
+        titles = {x["id"]["group"]: x.get("value") for x in ctx.inputs_list[2]}
+        params = {x["id"]["group"]: x.get("value") for x in ctx.states_list[-1]}
+        triggered = ctx.triggered_id
+        if isinstance(triggered, dict) and triggered.get("type") == "Graph1":
+            redraw = [g for g in groups if clickdatas.get(g) or g == triggered["group"]]
+        else:
+            redraw = groups
+        children = {g: no_update for g in groups}
+        for group in redraw:
+            if not crossfilter:
+                children[group] = html.P("Crossfilter disabled", className="lead")
+            elif not clickdatas.get(group):
+                children[group] = html.P(
+                    "Select a data point to crossfilter", className="lead"
+                )
+        todo = [g for g in redraw if children[g] is no_update]
+        data = _dfs_from_crossfilters(
+            [clickdatas[g] for g in todo],
             crossfilter,
-            [],
-            statistics,
+            [titles[g] for g in todo],
             crossfilter_sorting,
             crossfilter_page,
-            df,
+            lambda done, total: set_progress(_progress_text(done, total)),
+            [params.get(g) for g in todo],
         )
-        fig = bar_figure(df)
-        text = ""
-        for annotation in fig.layout.annotations:
-            if annotation.text.startswith("attr"):
-                text += f"{x_suffix} {annotation.text}"
-        fig.for_each_annotation(_pop_attr_annotation)
-        return [
-            html.Div(
-                html.I(
-                    className="bi bi-arrow-up-right-square-fill",
-                    title="No data point selected",
-                ),
-                id=id | {"type": "Link2"},
-                className="link-div",
-            ),
-            dcc.Markdown(text),
-            dcc.Graph(figure=fig, id=id | {"type": "Graph2"}),
-        ]
+        for group, (df, x_suffix) in zip(todo, data):
+            children[group] = _graph2_children(
+                SkeGraphAIO.ids.graph2(group),
+                df,
+                x_suffix,
+                corpora,
+                crossfilter,
+                statistics,
+                crossfilter_sorting,
+                crossfilter_page,
+            )
+        return [children[g] for g in groups]
@@ -0,0 +1,171 @@
+# Copyright (c) 2023 Loryn Isaacs
+# This file is part of Quartz, licensed under GPL3+ https://github.com/engisalor/quartz
+"""Bar charts of frequency data, without app settings (see `freqs_fig`)."""
+import functools
+
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+import plotly.io as pio
+
+# layout keys of the default template that apply to bar charts
+_template_keys = [
+    "autotypenumbers",
+    "colorway",
+    "font",
+    "hoverlabel",
+    "paper_bgcolor",
+    "plot_bgcolor",
+    "xaxis",
+    "yaxis",
+]
+
+
+@functools.lru_cache(maxsize=1)
+def _bar_template() -> go.layout.Template:
+    """Returns the parts of the default template used by bar charts."""
+    template = pio.templates[pio.templates.default]
+    layout = template.layout.to_plotly_json()
+    return go.layout.Template(
+        layout={k: v for k, v in layout.items() if k in _template_keys},
+        data={"bar": template.data.bar},
+    )
+
+
+@functools.lru_cache(maxsize=32)
+def _bar_layout(statistics: tuple) -> go.Layout:
+    """Returns the layout of a bar chart with a subplot for each statistic.
+
+    Notes:
+        Subplots are stacked top to bottom in the order of `statistics`, as
+        with `px.bar(facet_col="statistic", facet_col_wrap=1)`. Layouts are
+        cached and copied by `go.Figure`.
+    """
+    n = len(statistics)
+    spacing = 0.07
+    height = (1 - spacing * (n - 1)) / n if n else 1
+    axes, annotations = {}, []
+    for x, stat in enumerate(statistics):
+        suffix = str(n - x) if n - x > 1 else ""
+        bottom = (n - x - 1) * (height + spacing)
+        axes[f"xaxis{suffix}"] = {
+            "anchor": f"y{suffix}",
+            "domain": [0.0, 1.0],
+            "automargin": False,
+        }
+        if suffix:
+            axes[f"xaxis{suffix}"] |= {"matches": "x", "showticklabels": False}
+        axes[f"yaxis{suffix}"] = {
+            "anchor": f"x{suffix}",
+            "domain": [bottom, bottom + height],
+            "title": {"text": ""},
+        }
+        annotations.append(
+            {
+                "font": {"size": 15},
+                "showarrow": False,
+                "text": f"stat={stat}",
+                "x": 0.5,
+                "xanchor": "center",
+                "xref": "paper",
+                "y": bottom + height,
+                "yanchor": "bottom",
+                "yref": "paper",
+            }
+        )
+    if n:
+        axes["xaxis"] |= {
+            "title": {"text": ""},
+            "categoryorder": "category ascending",
+        }
+    return go.Layout(
+        {
+            "template": _bar_template(),
+            "annotations": annotations[::-1],
+            "legend": {"title": {"text": "corpus"}, "tracegroupgap": 0},
+            "margin": {"t": 20, "l": 0, "r": 0},
+            "barmode": "group",
+            "height": n * 150 + 150,
+            "hovermode": "x unified",
+            "plot_bgcolor": "#ffffff",
+        }
+        | axes
+    )
+
+
+def param_table(data: pd.DataFrame) -> list[str]:
+    """Returns each call's params once, as a side table for figure `customdata`."""
+    return pd.unique(data["params"]).tolist()
+
+
+def param_index(params: pd.Series, table: list | None) -> np.ndarray:
+    """Returns params as indexes into `table`, or as they are without one."""
+    if table is None:
+        return params.to_numpy()
+    return pd.Index(table).get_indexer(params)
+
+
+def bar_figure(
+    data: pd.DataFrame,
+    names: dict,
+    colors: dict,
+    arg=None,
+    params: list | None = None,
+) -> go.Figure:
+    """Builds a bar chart. Use `arg` to filter data for the desired query.
+
+    Args:
+        data: Figure data (see `freqs_fig.prep_data`).
+        names: Corpus names by `corpname`.
+        colors: Colors by corpus name.
+        arg: Query to draw.
+        params: Side table from `param_table` (indexes replace params in
+            `customdata`).
+
+    Notes:
+        Makes a `go.Bar` trace for each corpus and statistic from arrays of the
+        sorted data, with a cached layout (see `_bar_layout`). Looks like
+        `px.bar` faceted by statistic, without its validation and grouping
+        overhead. Clicks read `customdata` (params, attribute, value).
+        See `freqs_fig.bar_caption` for the text shown above the chart.
+    """
+    df = data.loc[data["arg"] == arg] if arg else data
+    codes, corpora = pd.factorize(df["corpname"])
+    labels = np.array([names.get(c, c) for c in corpora], dtype=object)
+    df = pd.DataFrame(
+        {
+            "corpus": labels[codes],
+            "f": df["f"].to_numpy(),
+            "value": df["value"].to_numpy(),
+            "statistic": df["statistic"].to_numpy(),
+            "params": param_index(df["params"], params),
+            "attribute": df["attribute"].to_numpy(),
+        }
+    ).sort_values(["corpus", "f", "value"], ignore_index=True)
+    statistics = tuple(sorted(df["statistic"].unique()))
+    x = df["value"].to_numpy()
+    y = df["f"].to_numpy()
+    custom = df[["params", "attribute", "value"]].to_numpy()
+    groups = df.groupby(["corpus", "statistic"], sort=True).indices
+    n = len(statistics)
+    axes = {stat: str(n - x) if n - x > 1 else "" for x, stat in enumerate(statistics)}
+    traces, legend = [], set()
+    for (corpus, stat), rows in groups.items():
+        traces.append(
+            go.Bar(
+                x=x[rows],
+                y=y[rows],
+                customdata=custom[rows],
+                name=corpus,
+                legendgroup=corpus,
+                offsetgroup=corpus,
+                alignmentgroup="True",
+                showlegend=corpus not in legend,
+                marker_color=colors.get(corpus),
+                hovertemplate="f=%{y:.2f}<extra></extra>",
+                xaxis=f"x{axes[stat]}",
+                yaxis=f"y{axes[stat]}",
+            )
+        )
+        legend.add(corpus)
+    return go.Figure(data=traces, layout=_bar_layout(statistics))
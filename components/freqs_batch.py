@@ -5,19 +5,25 @@ import pandas as pd
 from dash import html
 
 from components.aio.ske_graph import SkeGraphAIO
-from components.freqs_fig import bar_figure, choropleth_figure
+from components.bars import param_table
+from components.freqs_fig import bar_caption, bar_figure, choropleth_figure
 
 
 def bar_batch(data: pd.DataFrame) -> html.Div:
     """Builds a batch of bar graphs."""
     queries = data.drop_duplicates(["query", "arg"])
-    return [
-        SkeGraphAIO(
-            title=row["query"],
-            figure=bar_figure(data, row["arg"]),
+    graphs = []
+    for _, row in queries.sort_values("arg").iterrows():
+        params = param_table(data.loc[data["arg"] == row["arg"]])
+        graphs.append(
+            SkeGraphAIO(
+                title=row["query"],
+                params=params,
+                figure=bar_figure(data, row["arg"], params),
+                caption=bar_caption(data),
+            )
         )
-        for _, row in queries.sort_values("arg").iterrows()
-    ]
+    return graphs
 
 
 def choropleth_batch(data: pd.DataFrame) -> html.Div:
@@ -41,10 +47,12 @@ def choropleth_batch(data: pd.DataFrame) -> html.Div:
                 df = slice.loc[
                     (slice["corpname"] == c) & (~slice["iso3"].str.contains(r"\|"))
                 ].copy()
-                fig = choropleth_figure(df, c, stat, attribute, hover_data)
+                params = param_table(df)
+                fig = choropleth_figure(df, c, stat, attribute, hover_data, params)
                 graphs.append(
                     SkeGraphAIO(
                         title="&".join(df["query"].unique()),
+                        params=params,
                         figure=fig,
                         config=dict(responsive=True),
                     )
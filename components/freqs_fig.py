@@ -4,125 +4,67 @@ import textwrap
 
 import pandas as pd
 import plotly.express as px
+import plotly.graph_objects as go
 from dash import dash_table, html
 
+from components import bars
+from components.bars import param_index
 from settings import corp_data, env, stats
+from utils import convert
 
 
 def prep_data(
     corpora, attribute, attribute_filter, statistics, sort, page, df: pd.DataFrame
 ):
-    """Prepares frequency data from API calls for drawing figures."""
-    # filtering
-    query_args = []
+    """Prepares frequency data from API calls for drawing figures.
+
+    Notes:
+        Rows are filtered with masks and only the selected statistics are melted
+        (see `convert.melt_rows`).
+    """
+    filters = {"attribute": corp_data.catalog.attrs(corpora, attribute)}
     if len(corpora):
-        query_args.append("corpname in @corpora")
-    _df = corp_data.structures
-    attrs = _df.loc[  # noqa: F841
-        (_df["corpus"].isin(corpora)) & (_df["label"] == attribute), "attr"
-    ].to_list()
-    query_args.append("attribute in @attrs")
+        filters["corpname"] = corpora
     if len(attribute_filter):
-        query_args.append("value in @attribute_filter")
-    if len(query_args):
-        slice = df.query(" and ".join(query_args)).copy()
-    else:
-        slice = df.copy()
-    # melting statistics
-    melted_slice = slice.melt(
-        id_vars=[x for x in slice.columns if x not in stats.keys()],
+        filters["value"] = attribute_filter
+    melted = convert.melt_rows(
+        df,
+        filters,
+        id_vars=[x for x in df.columns if x not in stats],
+        value_vars=[x for x in df.columns if x in stats and x in statistics],
         var_name="statistic",
         value_name="f",
+        sort="value",
     )
-    melted_slice.query("statistic in @statistics", inplace=True)
-    melted_slice.sort_values("value", inplace=True)
-    melted_slice["sort"] = sort
-    melted_slice["page"] = page
-    return melted_slice
+    melted["sort"] = sort
+    melted["page"] = page
+    return melted
 
 
-def bar_figure(data: pd.DataFrame, arg=None) -> px.bar:
-    """Builds a bar chart. Use `arg` to filter data for the desired query."""
-    if arg:
-        df = data.query("arg == @arg").copy()
-    else:
-        df = data.copy()
-    df["corpus"] = df["corpname"].replace(
-        {k: corp_data.dt[k]["name"] for k in corp_data.dt.keys()}
-    )
-    df.sort_values(["corpus", "f", "value"], inplace=True)
-    df[""] = df["f"]  # patch for removing y axis subplot titles
-    df["cql"] = df["arg"].apply(lambda t: "<br>".join(textwrap.wrap(t, 80)))
-    df["val"] = df["value"].apply(lambda t: "<br>".join(textwrap.wrap(t, 80)))
-    fig = px.bar(
-        df,
-        x="value",
-        y="",
-        color="corpus",
-        color_discrete_map=corp_data.colors,
-        barmode="group",
-        facet_col="statistic",
-        facet_col_wrap=1,
-        facet_row_spacing=0.07,
-        custom_data=["params", "attribute", "value"],
-        height=len(df["statistic"].unique()) * 150 + 150,
-        hover_data={
-            "corpus": False,
-            "corpname": False,
-            "nicearg": False,
-            "value": False,
-            "": False,
-            "f": ":.2f",
-            "statistic": False,
-        },
-        category_orders={
-            "corpname": sorted(df["corpname"].unique()),
-            "statistic": sorted(df["statistic"].unique()),
-        },
-    )
-    fig.update_layout(
-        hovermode="x unified",
-        plot_bgcolor="#ffffff",
-        margin=dict(l=0, r=0, t=20),
-        xaxis_title="",
-        # yaxis_title="",
-        xaxis={"categoryorder": "category ascending"},
-    )
-    fig.update_yaxes(matches=None)
-    fig.update_xaxes(automargin=False)
-
-    attrs = []
-    for corpus in data["corpname"].unique():
-        for attr in data["attribute"].unique():
-            attrs.append(corp_data.dt[corpus]["label"].get(attr, None))
-
-    def bar_annotation(annotation, attrs=attrs):
-        "Abbreviates the default bar `statistics` annotation."
-        text = "stat=" + annotation.text.split("=")[-1]
-        annotation.update(text=text, font_size=15)
-
-    fig.for_each_annotation(bar_annotation)
-
-    text = f'attr=`{"&".join(set([x for x in attrs if x]))}`'
-    text += f' sort=`{"&".join(df["sort"].unique())}`'
-    text += f' page=`{"&".join(df["page"].unique().astype(str))}`'
-    text = "<br>".join(textwrap.wrap(text, 80))
-
-    fig.add_annotation(
-        xref="paper",
-        yref="paper",
-        x=0.5,
-        font_size=15,
-        showarrow=False,
-        text=text,
+def bar_figure(data: pd.DataFrame, arg=None, params: list | None = None) -> go.Figure:
+    """Builds a bar chart with corpus names and colors (see `bars.bar_figure`)."""
+    return bars.bar_figure(
+        data, corp_data.catalog.names, corp_data.catalog.colors, arg, params
     )
-    return fig
+
+
+def bar_caption(data: pd.DataFrame) -> str:
+    """Returns the attributes, sort and page of a bar chart (wrapped for display)."""
+    attrs = [
+        corp_data.catalog.label(corpus, attr)
+        for corpus in data["corpname"].unique()
+        for attr in data["attribute"].unique()
+    ]
+    text = f'attr=`{"&".join(dict.fromkeys([x for x in attrs if x]))}`'
+    text += f' sort=`{"&".join(data["sort"].unique())}`'
+    text += f' page=`{"&".join(data["page"].unique().astype(str))}`'
+    return "<br>".join(textwrap.wrap(text, 80))
 
 
 def choropleth_figure(
-    df: pd.DataFrame, corpus, stat, attribute, hover_data
+    df: pd.DataFrame, corpus, stat, attribute, hover_data, params: list | None = None
 ) -> px.choropleth:
-    """Builds a choropleth figure based on input variables."""
+    """Builds a choropleth figure based on input variables (see `bar_figure`)."""
     # annotations
     sort = "&".join(df["sort"].unique())
     page = "&".join(df["page"].unique().astype(str))
@@ -139,12 +81,13 @@ def choropleth_figure(
     else:
         anno_1 = ""
     footer = (
-        f'{corp_data.dt[corpus]["name"]}\t{corp_data.dt[corpus]["label"][attribute]}'
+        f"{corp_data.catalog.names[corpus]}\t"
+        + f"{corp_data.catalog.label(corpus, attribute)}"
         + f"<br>{anno_1}<br>{anno_0}<br>{anno_2}"
     )
     # create figure
     fig = px.choropleth(
-        df,
+        df.assign(params=param_index(df["params"], params)),
         locations="iso3",
         color=stat,
         custom_data=["params", "attribute", "value"],
@@ -167,35 +110,49 @@ def choropleth_figure(
     return fig
 
 
+def summary_records(data: pd.DataFrame, sort, page) -> list[dict]:
+    """Returns summary statistics for each query and corpus as table records.
+
+    Notes:
+        All columns are aggregated in one `groupby` over (`arg`, `corpname`), in
+        the order of these keys, and formatted as strings.
+    """
+    summary = data.groupby(["arg", "corpname"], sort=True).agg(
+        query=("query", "unique"),
+        attribute=("attribute", "unique"),
+        n=("value", "count"),
+        total_frq=("total_frq", "unique"),
+        frq_sum=("frq", "sum"),
+        total_fpm=("total_fpm", "unique"),
+        rel=("rel", "mean"),
+        reltt=("reltt", "mean"),
+        fpm=("fpm", "mean"),
+        frq=("frq", "mean"),
+    )
+    return [
+        {
+            "query": " & ".join(row.query),
+            "cql": arg,
+            "corpus": corp_data.catalog.names.get(c),
+            "attribute": corp_data.catalog.label(c, " & ".join(row.attribute)),
+            "n attr.": f"{row.n:,}",
+            "sort": sort,
+            "page": page,
+            "frq corp.": " & ".join([f"{x:,}" for x in row.total_frq]),
+            "frq attr.": f"{row.frq_sum:,}",
+            "fpm corp.": " & ".join([f"{x:,}" for x in row.total_fpm]),
+            "M rel %": f"{row.rel:,.2f}",
+            "M reltt": f"{row.reltt:,.2f}",
+            "M fpm": f"{row.fpm:,.2f}",
+            "M frq": f"{row.frq:,.2f}",
+        }
+        for (arg, c), row in zip(summary.index, summary.itertuples(index=False))
+    ]
+
+
 def data_table(data: pd.DataFrame, sort, page) -> html.Div:
-    """Builds a table of summary statistics."""
-
-    def make_record(c, arg):
-        df = data.query("corpname == @c and arg == @arg")
-        if not df.empty:
-            attr = " & ".join(df["attribute"].unique())
-            return {
-                "query": " & ".join(df["query"].unique()),
-                "cql": " & ".join(df["arg"].unique()),
-                "corpus": corp_data.dt[c].get("name"),
-                "attribute": corp_data.dt[c]["label"][attr],
-                "n attr.": f'{df["value"].count():,}',
-                "sort": sort,
-                "page": page,
-                "frq corp.": " & ".join([f"{x:,}" for x in df["total_frq"].unique()]),
-                "frq attr.": f'{df["frq"].sum():,}',
-                "fpm corp.": " & ".join([f"{x:,}" for x in df["total_fpm"].unique()]),
-                "M rel %": f'{df["rel"].mean():,.2f}',
-                "M reltt": f'{df["reltt"].mean():,.2f}',
-                "M fpm": f'{df["fpm"].mean():,.2f}',
-                "M frq": f'{df["frq"].mean():,.2f}',
-            }
-
-    records = []
-    for arg in sorted(data["arg"].unique()):
-        for c in sorted(data["corpname"].unique()):
-            records.append(make_record(c, arg))
-    records = [x for x in records if x]
+    """Builds a table of summary statistics (see `summary_records`)."""
+    records = summary_records(data, sort, page)
 
     tooltip = {
         "n attr.": f"Number of text types (up to the {env.MAX_ITEMS} most common)",
@@ -17,23 +17,25 @@ if not text_file:
 else:
     main_text = MarkdownFileAIO(text_file)
 
-layout = html.Div(
-    [
-        main_text,
-        html.Br(),
-        dbc.Tabs(
-            [
-                dbc.Tab(
-                    label=corp_data.dt[corpus]["name"],
-                    tab_id=corpus,
-                )
-                for corpus in [k for k in corp_data.dt.keys()]
-            ],
-            id="tabs",
-        ),
-        html.Div(id="content"),
-    ]
-)
+
+def layout():
+    return html.Div(
+        [
+            main_text,
+            html.Br(),
+            dbc.Tabs(
+                [
+                    dbc.Tab(
+                        label=corp_data.dt[corpus]["name"],
+                        tab_id=corpus,
+                    )
+                    for corpus in [k for k in corp_data.dt.keys()]
+                ],
+                id="tabs",
+            ),
+            html.Div(id="content"),
+        ]
+    )
 
 
 @dash.callback(Output("content", "children"), Input("tabs", "active_tab"))
@@ -1,25 +1,30 @@
 # Copyright (c) 2023 Loryn Isaacs
 # This file is part of Quartz, licensed under GPL3+ https://github.com/engisalor/quartz
-import json
 import logging
 import urllib
-from collections import Counter
 from pathlib import Path
 
 import dash
 import dash_bootstrap_components as dbc
 import pandas as pd
-from aiohttp import ClientConnectionError
+from aiohttp import ClientConnectionError, ClientResponseError
 from dash import ALL, Input, Output, State, ctx, dcc, get_app, html
-from flask import request
-from sgex.job import Job
+from dash.exceptions import PreventUpdate
+from flask import Response, abort, request, stream_with_context
 from sgex.query import simple_query
 
 from components import freqs_batch, freqs_fig
 from components.aio import aio
-from components.aio.ske_graph import _df_from_crossfilter
-from settings import corp_data, env, stats
-from utils import convert, redirect
+from components.aio.ske_graph import (
+    _cached_badge,
+    _crossfilter_key,
+    _df_from_crossfilter,
+    _params_from_point,
+    _progress_text,
+)
+from settings import client, corp_data, env, stats, store
+from utils import convert, export, freqstats, paging, redirect
+from utils.breaker import CircuitOpen
 
 app = get_app()
 
@@ -52,6 +57,14 @@ sorting_options = [
 ]
 
 
+def corpora_options() -> list[dict]:
+    """Returns options for the corpora picker (disabled until a corpus is ready)."""
+    return [
+        {"label": v["name"], "value": k, "disabled": not corp_data.is_ready(k)}
+        for k, v in corp_data.dt.items()
+    ]
+
+
 def layout(
     query="",
     corpora="",
@@ -85,6 +98,13 @@ def layout(
                 placeholder="Enter a word or phrase",
                 style={"minWidth": "180px", "flexGrow": 2},
             ),
+            dbc.Button(
+                "Cancel",
+                id="query-cancel-button",
+                color="light",
+                disabled=True,
+                title="Stop running queries",
+            ),
         ],
     )
 
@@ -92,13 +112,17 @@ def layout(
         [
             aio.PopoverHeaderAIO("Corpora", title="Select which corpus/corpora to use"),
             dcc.Checklist(
-                options=[
-                    {"label": v["name"], "value": k} for k, v in corp_data.dt.items()
-                ],
+                options=corpora_options(),
                 value=corpora,
                 id="corpora-picker",
                 className="settings-options",
             ),
+            # polls readiness while corpora are loading (see `enable_corpora`)
+            dcc.Interval(
+                id="corpora-interval",
+                interval=2000,
+                disabled=all(corp_data.is_ready(c) for c in corp_data.dt),
+            ),
         ]
     )
 
@@ -202,6 +226,24 @@ def layout(
         ]
     )
 
+    download_box = html.Div(
+        [
+            aio.PopoverHeaderAIO(
+                "Download format",
+                title="Choose a file format for downloading data",
+            ),
+            dcc.RadioItems(
+                options=[
+                    {"label": v["label"], "value": k} for k, v in export.formats.items()
+                ],
+                value="csv",
+                id="download-format-picker",
+                className="settings-options",
+                inline=True,
+            ),
+        ]
+    )
+
     top_panel = html.Div(
         [
             query_box,
@@ -235,11 +277,15 @@ def layout(
             ),
             html.I(
                 id="download-frequencies-button",
-                title="Download CSV data",
+                title="Download data",
                 className="bi bi-download",
             ),
-            dcc.Download(id="download-frequencies"),
+            dcc.Store(id="download-frequencies"),
+            dcc.Store(id="prefetch"),
+            dcc.Store(id="prefetch-status"),
             dcc.Clipboard(title="Copy URL to current plot", id="url-clipboard"),
+            html.Span(id="query-progress", className="query-progress"),
+            html.Span(id="crossfilter-progress", className="query-progress"),
             html.I(
                 id="guide-button",
                 className="bi bi-question-lg",
@@ -269,6 +315,7 @@ def layout(
                                 style={"display": "flex"},
                             ),
                             filter_box,
+                            download_box,
                         ]
                     )
                 ],
@@ -286,12 +333,29 @@ def layout(
                 id="table-collapse",
                 is_open=False,
             ),
+            html.Div(id="download-errors"),
             html.Br(),
             html.Div(id="frequencies-content", className="frequencies-content"),
         ]
     )
 
 
+@dash.callback(
+    Output("corpora-picker", "options"),
+    Output("corpora-interval", "disabled"),
+    Input("corpora-interval", "n_intervals"),
+    State("corpora-picker", "options"),
+    prevent_initial_call=True,
+)
+def enable_corpora(n_intervals, options):
+    """Enables corpora in the picker as they finish loading."""
+    _options = corpora_options()
+    done = not any(x["disabled"] for x in _options)
+    if _options == options:
+        return dash.no_update, done
+    return _options, done
+
+
 def set_attribute_value(options, value):
     """Ensures attribute-picker value is valid or falls back to default."""
 
@@ -307,18 +371,8 @@ def set_attribute_value(options, value):
 
 def set_attribute_options(corpora, value, options, extra=[]):
     if corpora:
-        q = "corpus in @corpora and exclude==False"
-        if len(corpora) > 1:
-            q += " and comparable==True"
-        vals = corp_data.structures.query(q)
-        counts = Counter(vals["label"].to_list())
-        options = vals.apply(
-            lambda row: {"label": row["label"], "value": row["label"]}, axis=1
-        ).to_list()
-        options = [x for x in options if counts[x["label"]] == len(corpora)]
-        options = list({v["label"]: v for v in options}.values())
-        options = sorted(options, key=lambda dt: dt["label"])
-        options = extra + options
+        labels = corp_data.catalog.labels(corpora)
+        options = extra + [{"label": x, "value": x} for x in labels]
     else:
         options, value = [], None
     value = set_attribute_value(options, value)
@@ -390,54 +444,132 @@ def toggle_table_collapse(n, is_open):
     return is_open
 
 
-def send_requests(input_text, corpora, attribute, sort, page):
+def query_units(input_text, corpora, attribute, sort, page) -> list[dict]:
+    """Breaks a submission into (corpus, CQL, attribute, sort, page) units."""
     queries = [x.strip() for x in input_text.split(";") if x.strip()]
     queries = queries[: env.MAX_QUERIES]
-    calls = []
-    query_map = {}
+    units = []
     for corpus in corpora:
-        label_map = {v: k for k, v in corp_data.dt[corpus]["label"].items()}
-        attr = label_map[attribute]
         for query in queries:
-            query = query.strip()
             if query.startswith("q,") and len(query) > 2:
                 cql = query[2:]
             else:
                 cql = simple_query(query)
-            query_map |= {cql: query}
-            calls.append(
+            units.append(
                 {
-                    "call_type": "Freqs",
-                    "q": "alc," + cql,
-                    "corpname": corpus,
-                    "fcrit": f"{attr} 0",
-                    "freq_sort": sort,
-                    "fmaxitems": env.MAX_ITEMS,
-                    "fpage": page,
-                    "group": 0,
-                    "showpoc": 1,
-                    "showreltt": 1,
-                    "showrel": 1,
+                    "corpus": corpus,
+                    "query": query,
+                    "cql": cql,
+                    "attr": corp_data.catalog.attr(corpus, attribute),
+                    "sort": sort,
+                    "page": page,
                 }
             )
-    j = Job(params=calls, **env.sgex)
-    j.run()
-    dfs = []
-    if not j.errors:
-        for call in j.data.freqs:
-            df = call.df_from_json()
-            if not df.empty:
-                df["params"] = json.dumps(call.params)
-                df["query"] = df["arg"].replace(query_map)
-            dfs.append(df)
-        dfs = pd.concat(dfs)
-    return dfs, j.errors
+    return units
+
+
+def unit_params(unit: dict) -> dict:
+    """Returns Freqs call parameters for a query unit.
+
+    Notes:
+        With `LOCAL_STATS`, only raw counts are requested and statistics are
+        derived from corpus sizes (see `CorpData.derive_stats`).
+    """
+    params = {
+        "call_type": "Freqs",
+        "q": "alc," + unit["cql"],
+        "corpname": unit["corpus"],
+        "fcrit": f'{unit["attr"]} 0',
+        "freq_sort": unit["sort"],
+        "fmaxitems": env.MAX_ITEMS,
+        "fpage": unit["page"],
+        "group": 0,
+    }
+    if not env.LOCAL_STATS:
+        params |= freqstats.server_params
+    return params
+
+
+def result_key(units: list[dict]) -> str:
+    """Returns the result store key for a list of query units."""
+    return store.key([unit_params(u) | {"query": u["query"]} for u in units])
+
+
+def send_requests(input_text, corpora, attribute, sort, page, progress=None):
+    """Gets frequencies for each query unit, sending only those not cached.
+
+    Args:
+        progress: Passed to `Client.run` to report finished calls.
+
+    Returns:
+        A frame with the results that were fetched and errors like `Client.run`,
+        with indexes in `query_units`.
+
+    Notes:
+        The combined frame is kept in the result store, keyed by the units'
+        call params, so changing statistics or filters doesn't rebuild it. If
+        some calls fail, the rest are still cached and only the failed ones are
+        sent on the next attempt. Frames with stale results aren't stored and
+        have a `cached_at` timestamp in `DataFrame.attrs`.
+    """
+    units = query_units(input_text, corpora, attribute, sort, page)
+    key = result_key(units)
+    df = store.get(key)
+    if df is not None:
+        return df, []
+    df, errors = paging.fetch_frame(
+        client,
+        [unit_params(u) for u in units],
+        env.PAGE_BLOCK,
+        progress,
+        derive=corp_data.derive_stats,
+        columns={"query": [u["query"] for u in units]},
+    )
+    stale = df.attrs.pop("cached_at", None)
+    if not df.empty:
+        df = df.drop(columns="call")
+    if stale:
+        df.attrs["cached_at"] = min(stale.values())
+    elif not errors:
+        store.set(key, df)
+    return df, errors
+
+
+def error_text(error) -> str:
+    """Describes an error from `Client.run` for users."""
+    if isinstance(error, CircuitOpen):
+        return "server unavailable, try again later"
+    if isinstance(error, str):
+        return f"server syntax error ({error})"
+    if isinstance(error, ClientResponseError):
+        return f"server error ({error.status})"
+    if isinstance(error, TimeoutError):
+        return "timed out (try a smaller query)"
+    if isinstance(error, ClientConnectionError):
+        return "server connection error"
+    return "unknown error"
+
+
+def error_notice(
+    errors: list, units: list[dict], title: str = "Some results are missing"
+) -> html.Div:
+    """Lists the corpora and queries that failed in a query."""
+    items = [
+        f"{corp_data.catalog.names.get(units[x]['corpus'], units[x]['corpus'])}, "
+        f"{units[x]['query']}: {error_text(error)}"
+        for error, _, x in errors
+    ]
+    return html.Div(
+        [html.P(title, className="lead")] + [html.P(item) for item in items],
+        className="query-errors",
+    )
 
 
 @dash.callback(
     Output("frequencies-content", "children"),
     Output("table", "children"),
     Output("attribute-filter", "options"),
+    Output("prefetch", "data"),
     Input("query-input", "n_submit"),
     Input("query-button", "n_clicks"),
     Input("corpora-picker", "value"),
@@ -448,8 +580,14 @@ def send_requests(input_text, corpora, attribute, sort, page):
     Input("page-picker", "value"),
     State("query-input", "value"),
     State("attribute-filter", "options"),
+    background=True,
+    progress=Output("query-progress", "children"),
+    progress_default=None,
+    running=[(Output("query-cancel-button", "disabled"), False, True)],
+    cancel=[Input("query-cancel-button", "n_clicks")],
 )
 def run_query(
+    set_progress,
     n_submit,
     n_clicks,
     corpora,
@@ -474,37 +612,50 @@ def run_query(
             messages.append("No statistics")
         if not attribute:
             messages.append("No attribute")
-        return html.P("; ".join(messages), className="lead"), None, []
+        return html.P("; ".join(messages), className="lead"), None, [], dash.no_update
     queries = [x.strip() for x in input_text.split(";") if x.strip()]
     if not isinstance(page, int) or not page > 0:
-        return html.P("Page must be a positive integer", className="lead"), None, []
+        return (
+            html.P("Page must be a positive integer", className="lead"),
+            None,
+            [],
+            dash.no_update,
+        )
     if len(queries) != len(set(queries)):
-        return html.P("No duplicate queries", className="lead"), None, []
+        return (
+            html.P("No duplicate queries", className="lead"),
+            None,
+            [],
+            dash.no_update,
+        )
     if len(queries) > env.MAX_QUERIES:
         return (
             html.P(f"{env.MAX_QUERIES} >= queries supported", className="lead"),
             None,
             [],
+            dash.no_update,
         )
-    # get data
-    df, errors = send_requests(input_text, corpora, attribute, sort, page)
-    # handle errors
+    # get data (in a background job: changing inputs cancels stale queries)
+    df, errors = send_requests(
+        input_text,
+        corpora,
+        attribute,
+        sort,
+        page,
+        lambda done, total: set_progress(_progress_text(done, total)),
+    )
+    # handle errors (results that were fetched are shown anyway)
+    notice = None
+    badge = None
+    if df.attrs.get("cached_at"):
+        badge = _cached_badge(df.attrs["cached_at"])
     if errors:
-        if isinstance(errors[0][0], ClientConnectionError):
-            return html.P("Server connection error", className="lead"), None, []
-        elif isinstance(errors[0][0], str):
-            return (
-                html.P(
-                    f"Server syntax error: {set(([x[0] for x in errors]))}",
-                    className="lead",
-                ),
-                None,
-                [],
-            )
-        else:
-            return html.P("Unknown error", className="lead"), None, []
+        units = query_units(input_text, corpora, attribute, sort, page)
+        notice = error_notice(errors, units)
+        if df.empty:
+            return notice, None, [], dash.no_update
     if df.empty:
-        return html.P("Nothing found", className="lead"), None, []
+        return html.P("Nothing found", className="lead"), None, [], dash.no_update
     # manage filter
     a_options = df["value"].to_list()
     if [x for x in a_options if "|" in x]:
@@ -516,14 +667,81 @@ def run_query(
     table = freqs_fig.data_table(df, sort, page)
     df = freqs_fig.prep_data(corpora, attribute, a_filter, statistics, sort, page, df)
     if df.empty:
-        return html.P("Nothing to graph", className="lead"), table, []
+        return html.P("Nothing to graph", className="lead"), table, [], dash.no_update
     # draw figs
-    is_choropleth = [corp_data.dt[c].get("choropleth", []) for c in corpora]
-    if attribute in [y for x in is_choropleth for y in x]:
+    if corp_data.catalog.is_choropleth(corpora, attribute):
         graphs = freqs_batch.choropleth_batch(df)
     else:
         graphs = freqs_batch.bar_batch(df)
-    return graphs, table, a_options
+    if notice:
+        graphs = [notice] + graphs
+    if badge:
+        graphs = [badge] + graphs
+    # queue prefetching (see `prefetch`)
+    prefetch = dash.no_update
+    if env.PREFETCH and not errors and not badge:
+        prefetch = {
+            "input_text": input_text,
+            "corpora": corpora,
+            "attribute": attribute,
+            "sort": sort,
+            "page": page,
+        }
+    return graphs, table, a_options, prefetch
+
+
+def prefetch_params(df: pd.DataFrame, sort, crossfilter, c_sort, c_page) -> list:
+    """Returns crossfilter params for the top `PREFETCH_TOP` values of each query."""
+    params = []
+    for _, group in df.groupby("query", sort=False):
+        top = group.groupby("value")[sort].max().nlargest(env.PREFETCH_TOP).index
+        for _, row in group[group["value"].isin(top)].iterrows():
+            point = {"customdata": [row["params"], row["attribute"], row["value"]]}
+            params.append(_params_from_point(point, crossfilter, c_sort, c_page)[0])
+    return params
+
+
+@dash.callback(
+    Output("prefetch-status", "data"),
+    Input("prefetch", "data"),
+    State("crossfilter-picker", "value"),
+    State("crossfilter-sort-picker", "value"),
+    State("crossfilter-page-picker", "value"),
+    background=True,
+    prevent_initial_call=True,
+)
+def prefetch(data, crossfilter, crossfilter_sorting, crossfilter_page):
+    """Fetches the next page and likely crossfilters into the cache.
+
+    Notes:
+        Calls are sent with low priority (see `RateLimiter`) after results are
+        shown. A new result cancels prefetching for the previous one.
+    """
+    if not data:
+        raise PreventUpdate
+    df = store.get(result_key(query_units(**data)))
+    if df is None or df.empty:
+        raise PreventUpdate
+    # only results with a full page can have a next one
+    sizes = df.groupby(["query", "corpname"]).size()
+    next_page = data | {"page": data["page"] + 1}
+    params = [
+        unit_params(u)
+        for u in query_units(**next_page)
+        if sizes.get((u["query"], u["corpus"]), 0) >= env.MAX_ITEMS
+    ]
+    if crossfilter and env.PREFETCH_TOP > 0:
+        params += prefetch_params(
+            df, data["sort"], crossfilter, crossfilter_sorting, crossfilter_page
+        )
+    _, errors = paging.fetch_frame(
+        client,
+        params,
+        env.PAGE_BLOCK,
+        priority="low",
+        derive=corp_data.derive_stats,
+    )
+    return {"calls": len(params), "errors": len(errors)}
 
 
 @dash.callback(
@@ -564,16 +782,20 @@ def copy_url(
 
 @dash.callback(
     Output("download-frequencies", "data"),
+    Output("download-errors", "children"),
     Input("download-frequencies-button", "n_clicks"),
     State("corpora-picker", "value"),
     State("attribute-picker", "value"),
     State("query-input", "value"),
     State({"type": "Graph1", "group": ALL}, "clickData"),
+    State({"type": "Params1", "group": ALL}, "data"),
+    State({"type": "Title", "group": ALL}, "data"),
     State("crossfilter-picker", "value"),
     State("sort-picker", "value"),
     State("page-picker", "value"),
     State("crossfilter-sort-picker", "value"),
     State("crossfilter-page-picker", "value"),
+    State("download-format-picker", "value"),
     prevent_initial_call=True,
 )
 def download_frequencies(
@@ -582,33 +804,151 @@ def download_frequencies(
     attribute,
     input_text,
     clickdata,
+    call_params,
+    titles,
     crossfilter,
     sort,
     page,
     crossfilter_sorting,
     crossfilter_page,
+    format,
 ):
-    """Prepares a file of the current data sample to download."""
+    """Returns a URL to download the current data sample from the result store.
 
-    dfs = [
-        _df_from_crossfilter(
-            cd, crossfilter, None, crossfilter_sorting, crossfilter_page
-        )
-        for cd in clickdata
-        if clickdata and crossfilter and cd
-    ]
-    dfs = [x[0] for x in dfs if x]
-    df = send_requests(input_text, corpora, attribute, sort, page)
-    df = pd.concat(dfs + [df])
+    Results are normally stored already (by displaying them); any that have
+    expired are fetched again first. Failed calls are listed instead (see
+    `error_notice`) and crossfilters that can't be fetched are left out.
+    """
 
-    if not df.empty:
-        df["corpname"].replace(
-            {k: corp_data.dt[k]["name"] for k in corp_data.dt.keys()}, inplace=True
+    if isinstance(input_text, str):
+        input_text = input_text.strip()
+    if not input_text or not corpora or not attribute:
+        raise PreventUpdate
+    if not isinstance(page, int) or not page > 0:
+        raise PreventUpdate
+    keys, missing = [], []
+    if crossfilter:
+        for cd, params, title in zip(clickdata, call_params, titles):
+            if not cd:
+                continue
+            args = (cd, crossfilter, title, crossfilter_sorting, crossfilter_page)
+            key = _crossfilter_key(*args, call_params=params)
+            if key not in store:
+                _df_from_crossfilter(*args, call_params=params)
+            if key in store:
+                keys.append(key)
+            else:
+                missing.append(html.P(f"{title}: crossfilter not included"))
+    units = query_units(input_text, corpora, attribute, sort, page)
+    key = result_key(units)
+    if key not in store:
+        _, errors = send_requests(input_text, corpora, attribute, sort, page)
+        if errors:
+            return None, error_notice(errors, units, "Download failed")
+        if key not in store:
+            # stale results (served while the server is down) aren't stored
+            return None, html.Div(
+                [
+                    html.P("Download failed", className="lead"),
+                    html.P(error_text(CircuitOpen())),
+                ],
+                className="query-errors",
+            )
+    keys.append(key)
+    names = [corp_data.catalog.names[c] for c in corpora]
+    file = "~".join(["~".join(names), input_text, attribute]) + "." + format
+    logging.debug(file)
+    args = {
+        "keys": ",".join(keys),
+        "sort": sort,
+        "page": page,
+        "format": format,
+        "name": file,
+    }
+    notice = None
+    if missing:
+        notice = html.Div(
+            [html.P("Some results are missing", className="lead")] + missing,
+            className="query-errors",
         )
-        df["sort"] = sort
-        df["page"] = page
-        df.drop(["params"], axis=1, inplace=True)
-        df.reset_index(drop=True, inplace=True)
-        file = "~".join(["~".join(df["corpname"].unique()), input_text, attribute])
-        logging.debug(file)
-        return dcc.send_data_frame(df.to_csv, file + ".csv")
+    return (
+        app.get_relative_path("/download?" + urllib.parse.urlencode(args)),
+        notice,
+    )
+
+
+dash.clientside_callback(
+    """function(href) {
+        if (href) {
+            const a = document.createElement("a");
+            a.href = href;
+            a.download = "";
+            document.body.appendChild(a);
+            a.click();
+            a.remove();
+        }
+        return null;
+    }""",
+    Output("download-frequencies", "clear_data"),
+    Input("download-frequencies", "data"),
+    prevent_initial_call=True,
+)
+
+
+def export_frames(readers: list, sort, page, batch_size: int = 10000):
+    """Yields stored result frames in batches, formatted for downloading."""
+    names = corp_data.catalog.names
+    columns = []
+    for reader in readers:
+        for col in reader.schema_arrow.names:
+            if col not in columns and col != "params":
+                if not col.startswith("__index_level_"):
+                    columns.append(col)
+    offset = 0
+    for reader in readers:
+        cols = [x for x in columns if x in reader.schema_arrow.names]
+        for batch in reader.iter_batches(batch_size, columns=cols):
+            df = batch.to_pandas().reindex(columns=columns)
+            if "corpname" in df:
+                df["corpname"] = df["corpname"].replace(names)
+            df["sort"] = sort
+            df["page"] = page
+            df.index = pd.RangeIndex(offset, offset + len(df))
+            offset += len(df)
+            yield df
+    if not offset:
+        yield pd.DataFrame(columns=columns + ["sort", "page"])
+
+
+@app.server.route("/download")
+def download():
+    """Streams stored result frames as a file (see `download_frequencies`)."""
+    format = request.args.get("format", "csv")
+    if format not in export.formats:
+        abort(400, f"Unsupported format {format}")
+    # the user's query is only used in the header, never in the path
+    file = request.args.get("name") or f"results.{format}"
+    readers = [store.reader(k) for k in request.args.get("keys", "").split(",")]
+
+    def close():
+        for reader in readers:
+            if reader is not None:
+                reader.close(force=True)
+
+    if None in readers:
+        close()
+        abort(404, "Results have expired: run the query again to download them")
+    frames = export_frames(
+        readers, request.args.get("sort"), request.args.get("page", type=int)
+    )
+    response = Response(
+        stream_with_context(export.stream(frames, format)),
+        mimetype=export.formats[format]["mimetype"],
+        headers={
+            "Content-Disposition": "attachment; filename*=UTF-8''"
+            + urllib.parse.quote(file, safe="")
+        },
+    )
+    # stored frames are read while streaming (see `FrameStore.reader`)
+    response.call_on_close(close)
+    return response
@@ -1,19 +1,39 @@
 # Copyright (c) 2023 Loryn Isaacs
 # This file is part of Quartz, licensed under GPL3+ https://github.com/engisalor/quartz
+import fcntl
+import json
 import logging
 import os
+import shutil
+import threading
+import time
 from dataclasses import dataclass
+from pathlib import Path
 
+import diskcache
 import pandas as pd
-from sgex.job import Job
+from sgex.job import default_servers, wait_dict
 from sgex.util import read_yaml
 
+from utils import decode, freqstats
+from utils.api import Client
+from utils.backends import Pool
+from utils.breaker import CircuitBreaker
+from utils.cache import FrameStore, ResultCache, make_key
+from utils.catalog import Catalog
+from utils.limiter import RateLimiter, wait_limits
+from utils.relay import RelayManager
+from utils.session import Session
+
 # logging
 logging.basicConfig(
     format="%(levelname)s - %(module)s.%(funcName)s - %(message)s", level=logging.INFO
 )
 
 
+SNAPSHOT_VERSION = 1
+
+
 # classes
 @dataclass
 class ENV:
@@ -30,10 +50,34 @@ class ENV:
         self.SORTING = os.getenv("SORTING")
         self.SERVER_URL = os.getenv("SERVER_URL")
         self.DASH_DEBUG = os.getenv("DASH_DEBUG")
+        self.CACHE_DB = os.getenv("CACHE_DB")
+        self.CACHE_MAX_MB = os.getenv("CACHE_MAX_MB")
+        self.CACHE_TTL = os.getenv("CACHE_TTL")
+        self.CORPORA_RELOAD = os.getenv("CORPORA_RELOAD")
+        self.ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+        self.JOBS_DIR = os.getenv("JOBS_DIR")
+        self.RATE_LIMIT = os.getenv("RATE_LIMIT")
+        self.RATE_BURST = os.getenv("RATE_BURST")
+        self.MAX_CONCURRENCY = os.getenv("MAX_CONCURRENCY")
+        self.POOL_SIZE = os.getenv("POOL_SIZE")
+        self.PAGE_BLOCK = os.getenv("PAGE_BLOCK")
+        self.PREFETCH = os.getenv("PREFETCH")
+        self.PREFETCH_TOP = os.getenv("PREFETCH_TOP")
+        self.LOCAL_STATS = os.getenv("LOCAL_STATS")
+        self.CROSSFILTER_TABLE = os.getenv("CROSSFILTER_TABLE")
+        self.CALL_TIMEOUT = os.getenv("CALL_TIMEOUT")
+        self.BREAKER_THRESHOLD = os.getenv("BREAKER_THRESHOLD")
+        self.BREAKER_COOLDOWN = os.getenv("BREAKER_COOLDOWN")
+        self.HEDGE_PERCENTILE = os.getenv("HEDGE_PERCENTILE")
+        self.BACKEND_RECHECK = os.getenv("BACKEND_RECHECK")
         for k, v in self.__dict__.items():
             if not v:
                 if k == "GUIDE_MD":
                     setattr(self, "GUIDE_MD", "config/user_guide.md")
+                if k == "CACHE_DB":
+                    setattr(self, "CACHE_DB", "data/cache.db")
+                if k == "JOBS_DIR":
+                    setattr(self, "JOBS_DIR", "data/jobs")
             elif (
                 v.startswith("'")
                 and v.endswith("'")
@@ -43,6 +87,38 @@ class ENV:
                 setattr(self, k, v.strip("\"'"))
             if k in ["MAX_QUERIES", "MAX_ITEMS"]:
                 setattr(self, k, int(v))
+            if k in ["CACHE_MAX_MB"]:
+                setattr(self, k, int(v) if v else 256)
+            if k in ["CACHE_TTL"]:
+                setattr(self, k, int(v) if v else 604800)
+            if k in ["CORPORA_RELOAD"]:
+                setattr(self, k, int(v) if v else 10)
+            if k in ["POOL_SIZE"]:
+                setattr(self, k, int(v) if v else 8)
+            if k in ["RATE_LIMIT"]:
+                setattr(self, k, float(v) if v else None)
+            if k in ["RATE_BURST", "MAX_CONCURRENCY"]:
+                setattr(self, k, int(v) if v else None)
+            if k in ["CALL_TIMEOUT"]:
+                setattr(self, k, float(v) if v else 60.0)
+            if k in ["BREAKER_THRESHOLD"]:
+                setattr(self, k, int(v) if v else 5)
+            if k in ["BREAKER_COOLDOWN"]:
+                setattr(self, k, float(v) if v else 30.0)
+            if k in ["HEDGE_PERCENTILE"]:
+                setattr(self, k, float(v) if v else 95.0)
+            if k in ["BACKEND_RECHECK"]:
+                setattr(self, k, float(v) if v else 10.0)
+            if k in ["CROSSFILTER_TABLE"]:
+                setattr(self, k, int(v) if v else 0)
+            if k in ["PAGE_BLOCK"]:
+                setattr(self, k, int(v) if v else 1)
+            if k in ["PREFETCH_TOP"]:
+                setattr(self, k, int(v) if v else 3)
+            if k in ["PREFETCH"]:
+                setattr(self, k, not v or v.lower() == "true")
+            if k in ["LOCAL_STATS"]:
+                setattr(self, k, bool(v) and v.lower() == "true")
             if k in ["DASH_DEBUG"]:
                 if not v:
                     setattr(self, k, False)
@@ -71,90 +147,467 @@ class ENV:
                 self.sgex[k] = v.strip("\"'")
             if k in ["verbose", "thread"] and isinstance(v, str):
                 self.sgex[k] = v.lower() == "true"
+            if k in ["wait_dict"] and v:
+                self.sgex[k] = json.loads(self.sgex[k])
         self.sgex = {k: v for k, v in self.sgex.items() if v}
+        # replicas with the same corpora, e.g. `SGEX_SERVER=http://a,http://b`
+        self.BACKENDS = [
+            x.strip() for x in self.sgex.get("server", "local").split(",") if x
+        ]
+        if "server" in self.sgex:
+            self.sgex["server"] = self.BACKENDS[0]
+        # server-aware limits: SkE's fair use follows SGEX's throttling, which
+        # can be changed with `SGEX_WAIT_DICT` (also for other servers)
+        server = default_servers.get(self.BACKENDS[0], self.BACKENDS[0])
+        waits = self.sgex.get("wait_dict")
+        if server == default_servers["ske"]:
+            waits = waits or wait_dict
+        defaults = {"RATE_LIMIT": 2.0, "RATE_BURST": 10, "MAX_CONCURRENCY": 8}
+        limits = wait_limits(waits) if waits else None
+        if limits:
+            defaults.update(zip(["RATE_LIMIT", "RATE_BURST"], limits))
+        if server == default_servers["ske"]:
+            defaults["MAX_CONCURRENCY"] = 1
+        for k, v in defaults.items():
+            if getattr(self, k) is None:
+                setattr(self, k, v)
 
 
 @dataclass
 class CorpData:
-    """Dataclass with corpus data."""
+    """Dataclass with corpus data.
 
-    def get_label(self, row: dict) -> str | None:
-        return self.dt.get(row["corpus"]).get("label").get(row["attr"], row["attr"])
+    Notes:
+        Corpus information loads in background threads, one corpus at a time, so
+        a corpus can be queried as soon as its CorpInfo call returns (and the app
+        starts even if the server is unavailable). Text type data (Wordlist calls)
+        is fetched next, so requests only read it (statistics derived with
+        `LOCAL_STATS` come from the server until it loads).
 
-    def is_in_list(self, row: dict, key: str) -> bool:
-        return row["attr"] in self.dt.get(row["corpus"]).get(key, [])
+        Loaded data is saved to a snapshot in the data directory, keyed by a hash
+        of the corpora config. Workers load an existing snapshot at startup and
+        refresh it in the background.
 
-    def run(self):
-        # load corpora file
-        self.dt = read_yaml(env.CORPORA_YML)
-        self.colors = {v["name"]: v["color"] for k, v in self.dt.items()}
-        corp_ids = list(self.dt.keys())
-        # make corpinfo calls
-        corpinfo_calls = [
-            {"call_type": "CorpInfo", "corpname": x, "struct_attr_stats": 1}
-            for x in corp_ids
+        Each worker checks the corpora file for changes every `CORPORA_RELOAD`
+        seconds (`0` disables) and reloads it with `reload`: only added or changed
+        corpora are fetched and the new data is swapped in at once.
+
+        Callbacks should use `catalog` (see `utils.catalog.Catalog`) for lookups
+        rather than querying `structures`.
+
+        Corpora with `backends` in their config are only sent to those servers
+        when several are set in `SGEX_SERVER` (see `utils.backends.Pool`).
+    """
+
+    tables = ["structures", "sizes", "ttypes"]
+    columns = {
+        "structures": [
+            "structure",
+            "attribute",
+            "size",
+            "corpus",
+            "attr",
+            "comparable",
+            "label",
+            "exclude",
+            "choropleth",
+        ],
+        "sizes": ["structure", "size", "corpus"],
+        "ttypes": ["str", "frq", "attribute", "corpus"],
+    }
+    wordlist_params = {
+        "call_type": "Wordlist",
+        "wlattr": None,
+        "wlmaxitems": None,
+        "wlsort": "frq",
+        "wlpat": ".*",
+        "wlminfreq": 1,
+        "wlicase": 1,
+        "wlmaxfreq": 0,
+        "wltype": "simple",
+        "include_nonwords": 1,
+        "random": 0,
+        "relfreq": 1,
+        "reldocf": 0,
+        "wlpage": 1,
+    }
+
+    def swap(self, dt: dict, data: dict):
+        """Replaces the config and data of all corpora at once.
+
+        Args:
+            dt: Corpora config.
+            data: DataFrames by table and corpus, e.g. `data["sizes"][corpus]`.
+        """
+        tables = {}
+        for t in self.tables:
+            frames = [data[t][c] for c in dt if c in data[t]]
+            if frames:
+                tables[t] = pd.concat(frames)
+            else:
+                tables[t] = pd.DataFrame(columns=self.columns[t])
+        with self.lock:
+            status = {c: "pending" for c in dt}
+            for c in dt:
+                if c in data["structures"]:
+                    status[c] = "ready"
+                elif self.dt.get(c) == dt[c] and not self.is_ready(c):
+                    # keep the status of corpora that are still loading
+                    status[c] = self.status.get(c, "pending")
+            # a single update so callbacks don't mix old and new attributes
+            vars(self).update(
+                dt=dt,
+                catalog=Catalog(dt, tables["structures"]),
+                data=data,
+                status=status,
+                **tables,
+            )
+
+    def route(self, dt: dict):
+        """Assigns servers to corpora with `backends` in their config."""
+        if client.pool:
+            client.pool.assign({c: (v or {}).get("backends") for c, v in dt.items()})
+
+    def is_ready(self, corpus: str) -> bool:
+        return self.status.get(corpus) == "ready"
+
+    def progress(self) -> dict:
+        """Returns the number of corpora loaded and the status of each."""
+        ready = [c for c in self.status if self.is_ready(c)]
+        return {
+            "ready": len(ready),
+            "total": len(self.status),
+            "corpora": dict(self.status),
+        }
+
+    def fetch_corpus(self, corpus: str, config: dict, use_cache: bool = True) -> tuple:
+        """Returns structures and sizes DataFrames for a corpus (CorpInfo call)."""
+        params = {"call_type": "CorpInfo", "corpname": corpus, "struct_attr_stats": 1}
+        data, errors = client.run([params], use_cache=use_cache)
+        if errors:
+            raise ConnectionError(f"CorpInfo call failed: {repr(errors[0][0])}")
+        _structures = data.corpinfo[0].structures_from_json()
+        _structures["corpus"] = corpus
+        _structures["attr"] = _structures["structure"] + "." + _structures["attribute"]
+        labels = config.get("label", {})
+        _structures["comparable"] = _structures["attr"].isin(
+            config.get("comparable", [])
+        )
+        _structures["label"] = [labels.get(x, x) for x in _structures["attr"]]
+        _structures["exclude"] = _structures["attr"].isin(config.get("exclude", []))
+        _structures["choropleth"] = _structures["attr"].isin(
+            config.get("choropleth", [])
+        )
+        _sizes = data.corpinfo[0].sizes_from_json()
+        _sizes["corpus"] = corpus
+        return _structures, _sizes
+
+    def fetch_ttypes(
+        self, corpus: str, attrs: pd.Series, use_cache: bool = True
+    ) -> pd.DataFrame:
+        """Returns text type frequencies for a corpus (Wordlist calls).
+
+        Args:
+            attrs: Number of values of each attribute (from CorpInfo).
+
+        Notes:
+            Only the `MAX_ITEMS` most frequent values are fetched, or all of them
+            with `LOCAL_STATS` (their sizes are needed to derive statistics).
+        """
+        calls = [
+            self.wordlist_params
+            | {
+                "wlattr": attr,
+                "wlmaxitems": max(env.MAX_ITEMS, int(size))
+                if env.LOCAL_STATS and size > 0
+                else env.MAX_ITEMS,
+                "corpname": corpus,
+            }
+            for attr, size in attrs.items()
+        ]
+        data, errors = client.run(calls, use_cache=use_cache)
+        if errors:
+            raise ConnectionError(f"Wordlist calls failed: {repr(errors[0][0])}")
+        ttypes = decode.wordlist_frame(
+            [call.response.text for call in data.wordlist],
+            {"corpus": [corpus] * len(calls)},
+        )
+        if ttypes.empty:
+            return pd.DataFrame(columns=self.columns["ttypes"])
+        return ttypes
+
+    def load_corpus(self, corpus: str, use_cache: bool = True):
+        """Fetches and adds data for a corpus (unless its config changed meanwhile)."""
+        config = self.dt[corpus]
+        structures, sizes = self.fetch_corpus(corpus, config, use_cache)
+        with self.lock:
+            if self.dt.get(corpus) != config:
+                return
+            data = {t: dict(v) for t, v in self.data.items()}
+            data["structures"][corpus] = structures
+            data["sizes"][corpus] = sizes
+            self.swap(self.dt, data)
+
+    def load_ttypes(self, corpus: str, use_cache: bool = True):
+        """Fetches and adds text type frequencies for a corpus."""
+        attrs = self.data["structures"][corpus].set_index("attr")["size"]
+        ttypes = self.fetch_ttypes(corpus, attrs, use_cache)
+        with self.lock:
+            if corpus not in self.data["structures"]:
+                return
+            data = {t: dict(v) for t, v in self.data.items()}
+            data["ttypes"][corpus] = ttypes
+            self.swap(self.dt, data)
+
+    def get_ttypes(self, corpus: str) -> pd.DataFrame:
+        """Returns text type frequencies for a corpus (empty until loaded)."""
+        return self.data["ttypes"].get(
+            corpus, pd.DataFrame(columns=self.columns["ttypes"])
+        )
+
+    def tokens(self, corpus: str) -> int | None:
+        """Returns the size of a corpus in tokens, if loaded."""
+        sizes = self.sizes.loc[
+            (self.sizes["corpus"] == corpus) & (self.sizes["structure"] == "token"),
+            "size",
         ]
-        j = Job(params=corpinfo_calls, **env.sgex)
-        j.run()
-        # make wordlist calls (text type data)
-        wordlist_params = {
-            "call_type": "Wordlist",
-            "wlattr": None,
-            "wlmaxitems": env.MAX_ITEMS,
-            "wlsort": "frq",
-            "wlpat": ".*",
-            "wlminfreq": 1,
-            "wlicase": 1,
-            "wlmaxfreq": 0,
-            "wltype": "simple",
-            "include_nonwords": 1,
-            "random": 0,
-            "relfreq": 1,
-            "reldocf": 0,
-            "wlpage": 1,
+        return int(sizes.iloc[0]) if len(sizes) else None
+
+    def derive_stats(self, df: pd.DataFrame) -> pd.DataFrame | None:
+        """Adds statistics to Freqs results with raw counts (see `freqstats`)."""
+        corpus = df["corpname"].iloc[0]
+        ttypes = self.get_ttypes(corpus)
+        ttypes = ttypes.loc[ttypes["attribute"] == df["attribute"].iloc[0]]
+        norms = ttypes.drop_duplicates("str").set_index("str")["frq"]
+        return freqstats.add_stats(df, norms, self.tokens(corpus))
+
+    def set_status(self, corpus: str, config: dict, status: str) -> bool:
+        """Sets the status of a corpus unless its config changed (returns success)."""
+        with self.lock:
+            if corpus not in self.status or self.dt.get(corpus) != config:
+                return False
+            self.status[corpus] = status
+            return True
+
+    def warm_up(self, corpus: str, config: dict):
+        """Loads a corpus and its text types, retrying until the server responds."""
+        wait = 1
+        if not self.is_ready(corpus):
+            self.set_status(corpus, config, "loading")
+        try:
+            while self.dt.get(corpus) == config and corpus not in self.data["ttypes"]:
+                try:
+                    if not self.is_ready(corpus):
+                        self.load_corpus(corpus)
+                        continue
+                    # queries can start meanwhile (with the server's statistics)
+                    self.load_ttypes(corpus)
+                except Exception as err:
+                    if not self.is_ready(corpus):
+                        self.set_status(corpus, config, f"retrying: {repr(err)}")
+                    logging.warning(
+                        f"{corpus} not loaded, retry in {wait}s: {repr(err)}"
+                    )
+                    time.sleep(wait)
+                    wait = min(wait * 2, 60)
+            with self.lock:
+                # removed or changed meanwhile (a new warm-up loads the new config)
+                if self.dt.get(corpus) != config or corpus not in self.data["ttypes"]:
+                    return
+        finally:
+            with self.lock:
+                if self.warming.get(corpus, config) == config:
+                    self.warming.pop(corpus, None)
+        logging.info(f"{corpus} loaded")
+        self.save_snapshot()
+
+    def warm_up_pending(self):
+        """Starts loading corpora that are pending or have no text types yet."""
+        with self.lock:
+            corpora = {
+                c: self.dt[c]
+                for c, v in self.status.items()
+                if (v == "pending" or c not in self.data["ttypes"])
+                and (c not in self.warming or self.warming[c] != self.dt[c])
+            }
+            self.warming |= corpora
+        for corpus, config in corpora.items():
+            threading.Thread(
+                target=self.warm_up, args=(corpus, config), daemon=True
+            ).start()
+
+    def run(self):
+        """Loads the corpora file and starts loading corpus data."""
+        dt = read_yaml(env.CORPORA_YML)
+        self.route(dt)
+        data = self.read_snapshot(dt)
+        if data:
+            self.swap(dt, data)
+            threading.Thread(target=self.refresh, daemon=True).start()
+        else:
+            self.swap(dt, {t: {} for t in self.tables})
+        self.warm_up_pending()
+        if env.CORPORA_RELOAD:
+            threading.Thread(target=self.watch, daemon=True).start()
+
+    def reload(self) -> dict:
+        """Applies changes to the corpora file, fetching added or changed corpora.
+
+        Returns:
+            Lists of `added`, `changed` and `removed` corpora.
+        """
+        with self.reload_lock:
+            dt = read_yaml(env.CORPORA_YML)
+            diff = {
+                "added": [c for c in dt if c not in self.dt],
+                "changed": [c for c in dt if c in self.dt and dt[c] != self.dt[c]],
+                "removed": [c for c in self.dt if c not in dt],
+            }
+            if not any(diff.values()):
+                return diff
+            self.route(dt)
+            path = self.snapshot_path(dt)
+            with open(path.with_name(f"{path.name}.lock"), "w") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                # another worker may have already reloaded the same config
+                data = self.read_snapshot(dt)
+                if data:
+                    self.swap(dt, data)
+                else:
+                    keep = [c for c in dt if c not in diff["added"] + diff["changed"]]
+                    data = {
+                        t: {c: v for c, v in self.data[t].items() if c in keep}
+                        for t in self.tables
+                    }
+                    for corpus in diff["added"] + diff["changed"]:
+                        try:
+                            structures, sizes = self.fetch_corpus(corpus, dt[corpus])
+                            data["structures"][corpus] = structures
+                            data["sizes"][corpus] = sizes
+                        except Exception as err:
+                            logging.warning(f"{corpus} not loaded: {repr(err)}")
+                    self.swap(dt, data)
+                    self.save_snapshot()
+            self.warm_up_pending()
+            logging.info(f"corpora reloaded: {diff}")
+            return diff
+
+    def watch(self):
+        """Reloads the corpora file when its contents change."""
+        while True:
+            time.sleep(env.CORPORA_RELOAD)
+            try:
+                if read_yaml(env.CORPORA_YML) != self.dt:
+                    self.reload()
+            except Exception as err:
+                logging.warning(f"corpora reload failed: {repr(err)}")
+
+    def snapshot_path(self, dt: dict = None) -> Path:
+        """Returns the snapshot path for a corpora config and the current server."""
+        config = json.dumps(dt or self.dt, sort_keys=True, ensure_ascii=False)
+        key = make_key(str(SNAPSHOT_VERSION), config, str(env.MAX_ITEMS), client.server)
+        path = Path(env.CACHE_DB).parent / "corp_data"
+        path.mkdir(parents=True, exist_ok=True)
+        return path / key
+
+    def read_snapshot(self, dt: dict) -> dict | None:
+        """Returns snapshot data by table and corpus, or `None` if unavailable."""
+        path = self.snapshot_path(dt)
+        try:
+            generation = path.resolve(strict=True)
+            frames = [pd.read_parquet(generation / f"{t}.parquet") for t in self.tables]
+        except (OSError, ValueError) as err:
+            logging.info(f"no corpus data snapshot: {err}")
+            return None
+        self.generation = generation.name
+        return {
+            t: {c: df.loc[df["corpus"] == c] for c in df["corpus"].unique()}
+            for t, df in zip(self.tables, frames)
         }
-        wordlist_calls = []
-        self.structures = pd.DataFrame()
-        self.sizes = pd.DataFrame()
-        for x in range(len(corp_ids)):
-            _structures = j.data.corpinfo[x].structures_from_json()
-            _structures["corpus"] = corp_ids[x]
-            _structures["attr"] = (
-                _structures["structure"] + "." + _structures["attribute"]
-            )
-            _structures["comparable"] = _structures.apply(
-                self.is_in_list, key="comparable", axis=1
-            )
-            _structures["label"] = _structures.apply(self.get_label, axis=1)
-            _structures["exclude"] = _structures.apply(
-                self.is_in_list, key="exclude", axis=1
-            )
-            _structures["choropleth"] = _structures.apply(
-                self.is_in_list, key="choropleth", axis=1
-            )
-            self.structures = pd.concat([self.structures, _structures])
-            _sizes = j.data.corpinfo[x].sizes_from_json()
-            _sizes["corpus"] = corp_ids[x]
-            self.sizes = pd.concat([self.sizes, _sizes])
-            wordlist_calls.extend(
-                [
-                    {**wordlist_params, "wlattr": attr, "corpname": corp_ids[x]}
-                    for attr in _structures["attr"]
-                ]
-            )
-        j = Job(params=wordlist_calls, **env.sgex)
-        j.run()
-        self.ttypes = pd.DataFrame()
-        for call in j.data.wordlist:
-            _ttypes = call.df_from_json()
-            _ttypes["corpus"] = call.params["corpname"]
-            self.ttypes = pd.concat([self.ttypes, _ttypes])
+
+    def save_snapshot(self):
+        """Saves corpus data to a new snapshot generation once all corpora load."""
+        with self.lock:
+            if [c for c in self.status if not self.is_ready(c)]:
+                return
+            path = self.snapshot_path()
+            tables = [getattr(self, t) for t in self.tables]
+        generation = path.with_name(f"{path.name}.{time.time_ns()}")
+        generation.mkdir(parents=True)
+        for t, df in zip(self.tables, tables):
+            df.to_parquet(generation / f"{t}.parquet")
+        link = path.with_name(f"{generation.name}.link")
+        link.symlink_to(generation.name)
+        os.replace(link, path)
+        self.generation = generation.name
+        # keep the previous generation for workers that are still reading it
+        old = sorted(path.parent.glob(f"{path.name}.*[0-9]"))[:-2]
+        for x in old:
+            shutil.rmtree(x, ignore_errors=True)
+
+    def refresh(self):
+        """Refreshes loaded corpus data and the snapshot (one worker at a time).
+
+        Notes:
+            Calls are sent to the server even if cached, so the refreshed data
+            (and the result cache) reflect the current corpora.
+        """
+        path = self.snapshot_path()
+        try:
+            with open(path.with_name(f"{path.name}.lock"), "w") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                if path.exists() and path.resolve().name != self.generation:
+                    # another worker refreshed the snapshot in the meantime
+                    data = self.read_snapshot(self.dt)
+                    if data:
+                        self.swap(self.dt, data)
+                else:
+                    for corpus in self.dt:
+                        self.load_corpus(corpus, use_cache=False)
+                        if corpus in self.data["ttypes"]:
+                            self.load_ttypes(corpus, use_cache=False)
+                    self.save_snapshot()
+            logging.info(f"corpus data refreshed: {self.generation}")
+        except Exception as err:
+            logging.warning(f"corpus data refresh failed: {repr(err)}")
 
     def __init__(self):
+        self.lock = threading.RLock()
+        self.reload_lock = threading.Lock()
+        self.generation = None
+        self.dt = {}
+        self.status = {}
+        self.warming = {}
         self.run()
 
 
 env = ENV()
+cache = ResultCache(env.CACHE_DB, env.CACHE_MAX_MB, env.CACHE_TTL)
+limiter = RateLimiter(
+    env.CACHE_DB, env.RATE_LIMIT, env.RATE_BURST, max_concurrency=env.MAX_CONCURRENCY
+)
+breaker = CircuitBreaker(env.CACHE_DB, env.BREAKER_THRESHOLD, env.BREAKER_COOLDOWN)
+pool = None
+if len(env.BACKENDS) > 1:
+    pool = Pool(
+        env.CACHE_DB,
+        env.BACKENDS,
+        recheck=env.BACKEND_RECHECK,
+        hedge=env.HEDGE_PERCENTILE,
+    )
+client = Client(
+    cache,
+    limiter=limiter,
+    session=Session(env.POOL_SIZE),
+    breaker=breaker,
+    timeout=env.CALL_TIMEOUT,
+    pool=pool,
+    **env.sgex,
+)
+store = FrameStore(cache, client.server)
+# slow callbacks run in separate processes (see `background=True` callbacks),
+# which send calls through their worker's session
+background = RelayManager(diskcache.Cache(env.JOBS_DIR), client.relay)
 corp_data = CorpData()
 stats = {
     "reltt": "reltt - relative text type fpm",
@@ -0,0 +1,47 @@
+# Copyright (c) 2023 Loryn Isaacs
+# This file is part of Quartz, licensed under GPL3+ https://github.com/engisalor/quartz
+"""Tests for statistics derived locally, against Freqs responses with stats."""
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils import decode, freqstats
+
+DATA = Path(__file__).parent / "data"
+# `sizes.tokencount` of the corpus (CorpInfo)
+TOKENS = 156236
+
+
+def _frame(name: str) -> pd.DataFrame:
+    return decode.freqs_frame([(DATA / f"{name}.json").read_text()])
+
+
+@pytest.fixture
+def norms() -> pd.Series:
+    ttypes = decode.wordlist_frame([(DATA / "wordlist_doc_file.json").read_text()])
+    return ttypes.set_index("str")["frq"]
+
+
+def test_add_stats_matches_server(norms):
+    server = _frame("freqs_stats").set_index("value")
+    local = freqstats.add_stats(_frame("freqs_frq"), norms, TOKENS).set_index("value")
+    local = local.loc[server.index]
+    for k in freqstats.decimals:
+        np.testing.assert_array_equal(local[k].to_numpy(), server[k].to_numpy(), k)
+
+
+def test_derive_rounds_like_server():
+    stats = freqstats.derive(np.array([1]), np.array([3]), 1e6, np.array([3]))
+    assert stats["fpm"].tolist() == [1.0]
+    assert stats["reltt"].tolist() == [333333.33]
+    # from unrounded values (333333.33 / 3 * 100 would give 11111111.0)
+    assert stats["rel"].tolist() == [11111111.1]
+
+
+def test_add_stats_needs_all_sizes(norms):
+    df = _frame("freqs_frq")
+    assert freqstats.add_stats(df, norms.drop("A01"), TOKENS) is None
+    assert freqstats.add_stats(df, norms, None) is None
+    assert freqstats.add_stats(df.iloc[:0], norms, TOKENS) is None
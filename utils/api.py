@@ -0,0 +1,590 @@
+# Copyright (c) 2023 Loryn Isaacs
+# This file is part of Quartz, licensed under GPL3+ https://github.com/engisalor/quartz
+"""Client for sending API calls via SGEX with a persistent result cache."""
+import asyncio
+import copy
+import logging
+import os
+import pickle
+import random
+import tempfile
+import threading
+import time
+from collections.abc import Callable
+from pathlib import Path
+
+import aiohttp
+from sgex import call as _call
+from sgex.job import Job, default_servers
+
+from utils.backends import Pool
+from utils.breaker import CircuitBreaker, CircuitOpen
+from utils.cache import ResultCache, make_key
+from utils.limiter import RateLimiter
+from utils.relay import Relay
+from utils.session import Session, Timing
+
+
+def make_call(params: dict) -> _call.Call:
+    """Returns an SGEX call object from a dict of params with a `call_type`."""
+    _params = {k: v for k, v in params.items() if k != "call_type"}
+    return getattr(_call, params["call_type"])(_params)
+
+
+def cached_response(text: str) -> _call.CachedResponse:
+    """Returns a response object for JSON text retrieved from the cache."""
+    return _call.CachedResponse(
+        None, None, headers={"Content-Type": "application/json"}, text=text
+    )
+
+
+def _portable(err: BaseException) -> BaseException:
+    """Returns an error that a job process can unpickle (see `Relay`)."""
+    try:
+        pickle.loads(pickle.dumps(err))
+        return err
+    except Exception:
+        if isinstance(err, aiohttp.ClientConnectionError):
+            return aiohttp.ClientConnectionError(str(err))
+        return RuntimeError(repr(err))
+
+
+def _is_overload(err: BaseException) -> bool | None:
+    """Whether an error signals an overloaded server (`None` if unrelated).
+
+    Timeouts are unrelated: slow calls (e.g. large corpora) time out again if
+    retried and aren't caused by sending too many calls. They still count as
+    failures for the `breaker`, as a server that stopped responding times out.
+    """
+    if isinstance(err, asyncio.TimeoutError):
+        return None
+    if isinstance(err, aiohttp.ClientResponseError):
+        return err.status == 429 or err.status >= 500
+    if isinstance(err, aiohttp.ClientConnectionError):
+        return True
+    return None
+
+
+class _Job(Job):
+    """A `Job` that paces calls with a `limiter` and reports them to `on_done`.
+
+    With a `session`, calls are sent through it (see `Session`) instead of a new
+    `aiohttp` session, `timings` records each call's connection timings and
+    setting the `cancel` event stops calls still running.
+    `priority` is passed to `RateLimiter.acquire`, calls are refused while a
+    `breaker` is open (see `CircuitBreaker`) and `timeout` limits each call.
+
+    Calls run concurrently with `thread` or a `limiter`, except for the `ske`
+    server: as with SGEX, they are sent one at a time, `wait` seconds apart.
+
+    With a `pool`, each call goes to a server picked by `Pool.pick`. A call still
+    running after `Pool.hedge_delay` is also sent to another server if the
+    limiter has spare capacity (a low priority permit), and the first response
+    is used.
+    """
+
+    on_done = None
+    limiter = None
+    session = None
+    priority = "normal"
+    breaker = None
+    timeout = None
+    pool = None
+    cancel = None
+
+    async def send_calls(self, session: aiohttp.ClientSession | None = None, **kwargs):
+        timeout = aiohttp.ClientTimeout(total=self.timeout) if self.timeout else None
+        if session is None:
+            if timeout:
+                kwargs["get_kwargs"] = {"timeout": timeout}
+            return await super().send_calls(**kwargs)
+        kwargs = {}
+        if timeout:
+            kwargs["timeout"] = timeout
+        elif self.server.startswith("http://localhost"):
+            kwargs["timeout"] = aiohttp.ClientTimeout(total=None)
+        calls = self.data.list()
+        self.timings = [Timing() for _ in calls]
+        self.wait_current = 0 - self.wait
+        sends = [
+            self.send_call(c, session, trace_request_ctx=t, **kwargs)
+            for c, t in zip(calls, self.timings)
+        ]
+        if self.thread or self.limiter and self.server != default_servers["ske"]:
+            res = await asyncio.gather(*sends, return_exceptions=True)
+        else:
+            res = []
+            for x, send in enumerate(sends):
+                if x and self.wait:
+                    await asyncio.sleep(self.wait)
+                # waits are spaced here rather than summed in `Job.send_call`
+                self.wait_current = 0 - self.wait
+                try:
+                    res.append(await send)
+                except Exception as err:
+                    res.append(err)
+        self.errors = []
+        for x in range(len(res)):
+            if not isinstance(res[x], tuple):
+                self.errors.append((res[x], calls[x], x))
+            elif res[x][0] not in ["", "unimplemented"]:
+                self.errors.append(res[x] + (x,))
+
+    def run(self):
+        if not self.session:
+            return super().run()
+        t0 = time.perf_counter()
+        self.cache_dir.mkdir(exist_ok=True)
+        self.parse_params()
+        self.set_wait()
+        self.session.run(self.send_calls, self.cancel)
+        self.time = time.perf_counter() - t0
+
+    async def _get(self, call: _call.Call, server: str, session, **kwargs) -> tuple:
+        """Sends a call to a server (like `Job.send_call`, without SGEX's cache)."""
+        file = Path(self.cache_dir) / call.hash()
+        _format = call.params.get("format", "json")
+        call.response = _call.CachedResponse(
+            file.with_suffix(".meta.json"), file.with_suffix(f".{_format}")
+        )
+        params = call.params
+        if self.username and self.api_key:
+            params = params | {"username": self.username, "api_key": self.api_key}
+        async with session.get(
+            url=server.rstrip("/") + "/" + call.type, params=params, **kwargs
+        ) as response:
+            await call.response.set(response)
+        return (call.response.ske_error, str(call))
+
+    async def _send_to(self, call, server, session, hedge=False, **kwargs) -> tuple:
+        t0 = time.perf_counter()
+        ok = None
+        try:
+            result = await self._get(call, server, session, **kwargs)
+            ok = True
+            return result
+        except Exception as err:
+            overload = _is_overload(err)
+            ok = None if overload is None else not overload
+            raise
+        finally:
+            elapsed = time.perf_counter() - t0
+            await asyncio.to_thread(self.pool.finish, server, elapsed, ok, hedge)
+
+    async def _route(self, call: _call.Call, session, **kwargs) -> tuple:
+        """Sends a call via the pool, hedging it if it's slow."""
+        corpus = call.params.get("corpname")
+        server = await asyncio.to_thread(self.pool.pick, corpus)
+        first = asyncio.ensure_future(self._send_to(call, server, session, **kwargs))
+        delay = await asyncio.to_thread(self.pool.hedge_delay)
+        if delay is None or (await asyncio.wait({first}, timeout=delay))[0]:
+            return await first
+        permit = None
+        if self.limiter:
+            permit = await asyncio.to_thread(self.limiter.try_acquire, "low")
+            if permit is None:
+                return await first
+        hedge, second = copy.copy(call), None
+        t0 = time.perf_counter()
+        try:
+            other = await asyncio.to_thread(self.pool.pick, corpus, [server])
+            if other is None:
+                return await first
+            second = asyncio.ensure_future(
+                self._send_to(hedge, other, session, True, **kwargs)
+            )
+            pending = {first, second}
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if not task.exception():
+                        if task is second:
+                            call.response = hedge.response
+                        return task.result()
+            # both failed: the first call's error is reported
+            return await first
+        finally:
+            for task in [first, second]:
+                if task:
+                    task.cancel()
+            if permit is not None:
+                elapsed = time.perf_counter() - t0
+                await asyncio.to_thread(self.limiter.release, permit, elapsed, None)
+
+    async def send_call(self, call: _call.Call, session, **kwargs):
+        if self.breaker and not await asyncio.to_thread(self.breaker.allow):
+            if self.on_done:
+                await asyncio.to_thread(self.on_done)
+            raise CircuitOpen(self.server)
+        permit = await self.limiter.acquire(self.priority) if self.limiter else None
+        t0 = time.perf_counter()
+        ok, healthy = None, None
+        try:
+            if self.pool:
+                result = await self._route(call, session, **kwargs)
+            else:
+                result = await super().send_call(call, session, **kwargs)
+            ok, healthy = True, True
+            return result
+        except Exception as err:
+            overload = _is_overload(err)
+            ok = None if overload is None else not overload
+            healthy = False if isinstance(err, asyncio.TimeoutError) else ok
+            raise
+        finally:
+            if permit is not None:
+                elapsed = time.perf_counter() - t0
+                await asyncio.to_thread(self.limiter.release, permit, elapsed, ok)
+            if self.breaker and healthy is not None:
+                await asyncio.to_thread(self.breaker.record, healthy)
+            if self.on_done:
+                await asyncio.to_thread(self.on_done)
+
+
+class _Flight:
+    """A call being fetched by another thread in this process."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.outcome = None
+
+
+class Client:
+    """Sends API calls, skipping any with results in the cache.
+
+    Args:
+        cache: Result cache shared by all workers (optional).
+        lease: Seconds to wait for identical calls sent by other threads/workers.
+        limiter: Rate limiter shared by all workers (replaces SGEX throttling,
+            except between calls to the `ske` server).
+        session: Persistent HTTP session for all calls (else one per `Job`).
+        retries: Times to resend calls that failed with a transient error.
+        backoff: Seconds before the first retry (doubled each time, with jitter).
+        breaker: Circuit breaker shared by all workers (fails fast while open).
+        timeout: Seconds before a call fails (default: none for localhost
+            servers, else `aiohttp`'s).
+        refresh: Stale results to fetch again after the server recovers.
+        pool: Replicas of the server to spread calls over (see `Pool`).
+        sgex: Arguments passed to `sgex.job.Job` (server, api_key, etc.).
+
+    Methods:
+        key: Returns the cache key for a call.
+        is_cached: Whether the result of a call is cached.
+        run: Executes a list of calls and returns `(data, errors)`.
+
+    Notes:
+        Identical calls in flight at the same time are sent once (single-flight):
+        threads wait for the one sending a call and share its response, while
+        other processes wait for its result in the cache (via a lease in the
+        cache). These calls are counted as `coalesced` in the cache stats.
+        Successful results are cached as they arrive, so when some calls fail
+        only those are sent again (by retries or a later `run`). Results are
+        cached under `server` whichever replica of a pool sent them.
+
+        Calls that still fail get expired results from the cache if any
+        (stale-while-revalidate), with a `cached_at` timestamp set on their
+        response. Once the breaker closes, a later `run` fetches the most
+        requested of these again in the background (low priority).
+    """
+
+    def key(self, call: _call.Call) -> str:
+        return make_key(self.server, call.type, call.json())
+
+    def is_cached(self, params: dict) -> bool:
+        return bool(self.cache) and self.key(make_call(params)) in self.cache
+
+    def _claim_local(self, keys: list[str]) -> tuple[list, dict]:
+        """Returns keys this thread will fetch and flights to wait for."""
+        own, flights = [], {}
+        with self._lock:
+            for key in keys:
+                if key in self._flights:
+                    flights[key] = self._flights[key]
+                else:
+                    self._flights[key] = _Flight()
+                    own.append(key)
+        return own, flights
+
+    def _resolve(self, key: str, outcome: tuple | None):
+        with self._lock:
+            flight = self._flights.pop(key, None)
+        if flight:
+            flight.outcome = outcome
+            flight.event.set()
+
+    def _forget(self):
+        # flights of the parent process never finish in a forked child
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def _wait(self, key: str) -> str | None:
+        """Waits for another process to fetch a call and returns the cached text."""
+        delay = 0.05
+        deadline = time.monotonic() + self.lease
+        while time.monotonic() < deadline:
+            if key in self.cache or not self.cache.is_claimed(key):
+                break
+            time.sleep(delay)
+            delay = min(delay * 2, 0.5)
+        value = self.cache.get(key) if key in self.cache else None
+        return value.decode() if value is not None else None
+
+    def _log_timings(self, j: _Job):
+        """Logs how much of a job's time went to connection setup."""
+        timings = getattr(j, "timings", [])
+        if not timings:
+            return
+        connect = sum(t.connect for t in timings)
+        reused = sum(t.reused for t in timings)
+        logging.info(
+            f"{len(timings)} calls in {j.time:.3f}s: connection setup "
+            f"{connect:.3f}s, waiting for connections "
+            f"{sum(t.queued for t in timings):.3f}s, "
+            f"{reused}/{len(timings)} connections reused"
+        )
+        if self.cache:
+            for name, n in {
+                "requests": len(timings),
+                "requests_reused": reused,
+                "request_ms": round(sum(t.total for t in timings) * 1000),
+                "connect_ms": round(connect * 1000),
+            }.items():
+                self.cache.incr(name, n)
+
+    def _retryable(self, error) -> bool:
+        if self.breaker and self.breaker.is_open():
+            return False
+        # calls refused while the server was tested are sent once it's up
+        return isinstance(error, CircuitOpen) or bool(_is_overload(error))
+
+    def _refresh(self):
+        """Fetches stale results that were served again once the server is up."""
+        # not while testing the server, which is left to user requests
+        if not self.breaker.is_closed():
+            return
+        params = self.cache.take_stale(self.refresh)
+        if not params or not self.cache.claim(["refresh"], os.getpid(), self.lease):
+            return
+
+        def refresh():
+            try:
+                logging.info(f"refreshing {len(params)} stale results")
+                self.run(params, priority="low")
+            finally:
+                self.cache.release(["refresh"], os.getpid())
+
+        threading.Thread(target=refresh, name="refresh", daemon=True).start()
+
+    def _send(
+        self,
+        params: list[dict],
+        on_done=None,
+        priority: str = "normal",
+        cancel: threading.Event | None = None,
+    ) -> dict:
+        """Sends calls and returns `{key: (response, error)}`, caching successes.
+
+        Calls still running when `cancel` is set (by `Relay`) are stopped and
+        `concurrent.futures.CancelledError` is raised.
+        """
+        if self.breaker and self.breaker.is_open():
+            # fail fast instead of waiting for a server that is down
+            outcomes = {}
+            for p in params:
+                outcomes[self.key(make_call(p))] = (None, CircuitOpen(self.server))
+                if on_done:
+                    on_done()
+            return outcomes
+        # SGEX's file cache is bypassed so expiry/eviction is handled here
+        with tempfile.TemporaryDirectory() as tmp:
+            j = _Job(params=params, cache_dir=tmp, **self.sgex)
+            j.on_done = on_done
+            j.limiter = self.limiter
+            j.session = self.session
+            j.priority = priority
+            j.breaker = self.breaker
+            j.timeout = self.timeout
+            j.pool = self.pool
+            j.cancel = cancel
+            j.run()
+        self._log_timings(j)
+        failed = {e[2]: _portable(e[0]) for e in j.errors}
+        outcomes = {}
+        for x, call in enumerate(j.data.list()):
+            key = self.key(call)
+            response = call.response
+            outcomes[key] = (response, failed.get(x))
+            if (
+                self.cache
+                and x not in failed
+                and response
+                and response.ske_error == ""
+                and response.text
+            ):
+                self.cache.set(key, response.text, priority == "low")
+        return outcomes
+
+    def run(
+        self,
+        params: list[dict],
+        progress: Callable[[int, int], None] | None = None,
+        priority: str = "normal",
+        use_cache: bool = True,
+    ) -> tuple[_call.Data, list]:
+        """Executes a list of calls, sending only those missing from the cache.
+
+        Args:
+            params: Call parameters, each with a `call_type` (e.g. `Freqs`).
+            progress: Called with `(done, total)` unique calls as calls finish.
+            priority: `low` for speculative calls (prefetching): these wait for
+                spare capacity in the limiter, don't count as cache hits/misses
+                and are counted as `prefetched` when stored.
+            use_cache: `False` to send calls even if their results are cached
+                (e.g. to refresh them); new results are still cached.
+
+        Returns:
+            A `Data` object with calls in the same order as `params` and a list of
+            errors like `Job.errors`: `(error, call, index in params)`.
+        """
+        if self.breaker and self.cache and priority == "normal":
+            self._refresh()
+        calls = [make_call(p) for p in params]
+        keys = [self.key(call) for call in calls]
+        # identical calls in a batch are looked up and sent once
+        units = {}
+        for x, key in enumerate(keys):
+            units.setdefault(key, []).append(x)
+        missing = []
+        for key, xs in units.items():
+            text = None
+            if self.cache and use_cache:
+                text = self.cache.get(key, priority == "low")
+            if text is None:
+                missing.append(key)
+            else:
+                for x in xs:
+                    calls[x].response = cached_response(text.decode())
+        if len(units):
+            logging.debug(f"cache hits {len(units) - len(missing)}/{len(units)}")
+        done = [len(units) - len(missing)]
+
+        def on_done():
+            done[0] += 1
+            if progress:
+                progress(done[0], len(units))
+
+        if progress:
+            progress(done[0], len(units))
+        outcomes = {}
+        coalesced = []
+        own, flights = self._claim_local(missing)
+        try:
+            remote = []
+            if own and self.cache:
+                claimed = self.cache.claim(own, os.getpid(), self.lease)
+                remote = [k for k in own if k not in claimed]
+            send = [k for k in own if k not in remote]
+            if send:
+                try:
+                    outcomes |= self.relay(
+                        [params[units[k][0]] for k in send],
+                        on_done=on_done,
+                        priority=priority,
+                    )
+                finally:
+                    if self.cache:
+                        self.cache.release(send, os.getpid())
+                for key in send:
+                    self._resolve(key, outcomes.get(key))
+            for key in remote:
+                text = self._wait(key)
+                if text is not None:
+                    outcomes[key] = (cached_response(text), None)
+                    coalesced.append(key)
+                    self._resolve(key, outcomes[key])
+                    on_done()
+            for key, flight in flights.items():
+                if flight.event.wait(self.lease) and flight.outcome:
+                    outcomes[key] = flight.outcome
+                    coalesced.append(key)
+                    on_done()
+            # calls whose sender failed without a result are sent again
+            leftover = [k for k in missing if k not in outcomes]
+            if leftover:
+                outcomes |= self.relay(
+                    [params[units[k][0]] for k in leftover],
+                    on_done=on_done,
+                    priority=priority,
+                )
+            # transient failures (connection errors, 429/5xx) are sent again
+            for attempt in range(self.retries):
+                retry = [k for k in missing if self._retryable(outcomes[k][1])]
+                if not retry:
+                    break
+                time.sleep(self.backoff * 2**attempt * random.uniform(0.5, 1.5))
+                logging.info(f"retrying {len(retry)}/{len(units)} failed calls")
+                outcomes |= self.relay(
+                    [params[units[k][0]] for k in retry], priority=priority
+                )
+            # expired results are better than none when the server fails
+            for key in missing:
+                if outcomes[key][1] is not None and self.cache:
+                    row = self.cache.stale(key, params[units[key][0]])
+                    if row:
+                        response = cached_response(row[0].decode())
+                        response.cached_at = row[1]
+                        outcomes[key] = (response, None)
+        finally:
+            for key in own:
+                self._resolve(key, outcomes.get(key))
+        if coalesced:
+            logging.debug(f"coalesced {len(coalesced)}/{len(units)}")
+            if self.cache:
+                self.cache.incr("coalesced", len(coalesced))
+        errors = []
+        for key in missing:
+            response, error = outcomes[key]
+            for x in units[key]:
+                calls[x].response = response
+                if error is not None:
+                    errors.append((error, calls[x], x))
+        errors.sort(key=lambda e: e[2])
+        data = _call.Data()
+        data.add(calls)
+        return data, errors
+
+    def __init__(
+        self,
+        cache: ResultCache | None = None,
+        lease: float = 120,
+        limiter: RateLimiter | None = None,
+        session: Session | None = None,
+        retries: int = 2,
+        backoff: float = 1,
+        breaker: CircuitBreaker | None = None,
+        timeout: float | None = None,
+        refresh: int = 20,
+        pool: Pool | None = None,
+        **sgex,
+    ):
+        self.cache = cache
+        self.lease = lease
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = breaker
+        self.timeout = timeout
+        self.refresh = refresh
+        self.pool = pool
+        self.limiter = limiter
+        self.session = session
+        self.relay = Relay(self._send)
+        server = sgex.get("server", "local")
+        self.server = default_servers.get(server, server)
+        if limiter and self.server != default_servers["ske"]:
+            # no fixed waits between calls: the limiter paces all workers
+            sgex = sgex | {"wait_dict": {"0": None}}
+        self.sgex = sgex
+        self._forget()
+        os.register_at_fork(after_in_child=self._forget)
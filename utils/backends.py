@@ -0,0 +1,252 @@
+# Copyright (c) 2023 Loryn Isaacs
+# This file is part of Quartz, licensed under GPL3+ https://github.com/engisalor/quartz
+"""Routing API calls across servers with the same corpora."""
+import os
+import sqlite3
+import time
+from pathlib import Path
+
+from sgex.job import default_servers
+
+from utils.cache import alive, transaction
+
+
+class Pool:
+    """Spreads calls over replicas of a server, with state stored in SQLite.
+
+    Args:
+        file: Database path (shared by all workers and threads).
+        servers: Server URLs (or SGEX names like `local`).
+        threshold: Consecutive failures before a server is taken out of rotation.
+        recheck: Seconds before a server out of rotation gets a call again.
+        hedge: Latency percentile after which a call is also sent to another
+            server (`0` disables hedging).
+        window: Recent latencies kept to compute `hedge`.
+        timeout: Seconds before an unfinished call is no longer counted.
+
+    Methods:
+        assign: Sets the servers of each corpus.
+        pick: Returns the server for a call and counts it as outstanding.
+        finish: Records the outcome of a call.
+        hedge_delay: Returns seconds to wait before hedging a call.
+        stats: Returns the state of each server.
+
+    Notes:
+        Calls go to the server with the fewest calls in flight (least outstanding
+        requests) among those assigned to their corpus, or all servers. Counts,
+        health and latencies are shared by all workers and their background
+        jobs; calls of exited processes are dropped as with `RateLimiter`.
+
+        Health is checked passively: a server is taken out of rotation after
+        `threshold` consecutive errors (connection errors, 429/5xx)
+        and gets a single call after `recheck` seconds, which puts it back if it
+        succeeds. If all servers of a corpus are out, they are all used (see
+        `CircuitBreaker` for failing fast).
+
+        Hedged calls go to another healthy server and the first response is
+        used (see `_Job`).
+    """
+
+    schema = [
+        """CREATE TABLE IF NOT EXISTS backends (
+            server TEXT PRIMARY KEY,
+            calls INTEGER NOT NULL DEFAULT 0,
+            failures INTEGER NOT NULL DEFAULT 0,
+            down REAL NOT NULL DEFAULT 0
+        )""",
+        """CREATE TABLE IF NOT EXISTS backend_calls (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            server TEXT NOT NULL,
+            owner INTEGER NOT NULL,
+            expires REAL NOT NULL
+        )""",
+        """CREATE TABLE IF NOT EXISTS backend_latencies (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            latency REAL NOT NULL
+        )""",
+        """CREATE TABLE IF NOT EXISTS hedging (
+            id INTEGER PRIMARY KEY CHECK (id = 0),
+            hedged INTEGER NOT NULL,
+            wins INTEGER NOT NULL
+        )""",
+    ]
+
+    def _add(self, con: sqlite3.Connection, servers: list[str]):
+        con.executemany(
+            "INSERT OR IGNORE INTO backends (server) VALUES (?)",
+            [(s,) for s in servers],
+        )
+
+    def _state(self, con: sqlite3.Connection, now: float) -> dict:
+        """Returns `{server: (outstanding, calls, failures, down)}`."""
+        rows = con.execute("SELECT DISTINCT owner FROM backend_calls").fetchall()
+        dead = [(x[0],) for x in rows if not alive(x[0])]
+        con.executemany("DELETE FROM backend_calls WHERE owner = ?", dead)
+        con.execute("DELETE FROM backend_calls WHERE expires < ?", (now,))
+        outstanding = dict(
+            con.execute("SELECT server, COUNT(*) FROM backend_calls GROUP BY server")
+        )
+        return {
+            s: (outstanding.get(s, 0), calls, failures, down)
+            for s, calls, failures, down in con.execute(
+                "SELECT server, calls, failures, down FROM backends"
+            )
+        }
+
+    def assign(self, routes: dict[str, list[str]]):
+        """Sets the servers of each corpus (others can use any server)."""
+        routes = {
+            corpus: [default_servers.get(s, s) for s in servers]
+            for corpus, servers in routes.items()
+            if servers
+        }
+        with transaction(self.file) as con:
+            self._add(con, sum(routes.values(), []))
+        self.routes = routes
+
+    def pick(self, corpus: str | None = None, exclude: list = []) -> str | None:
+        """Returns the least busy healthy server, or `None` if none is left.
+
+        Args:
+            corpus: Corpus of the call.
+            exclude: Servers already sending the call (no fallback to unhealthy
+                servers if given).
+        """
+        now = time.time()
+        with transaction(self.file) as con:
+            state = self._state(con, now)
+            servers = self.routes.get(corpus, self.servers)
+            servers = [s for s in servers if s not in exclude and s in state]
+            healthy = [s for s in servers if state[s][3] <= now]
+            if not healthy and exclude:
+                return None
+            server = min(healthy or servers, key=lambda s: state[s][:2], default=None)
+            if server is None:
+                return None
+            if state[server][2] >= self.threshold:
+                # one call tests the server, others wait for its outcome
+                con.execute(
+                    "UPDATE backends SET down = ? WHERE server = ?",
+                    (now + self.recheck, server),
+                )
+            con.execute(
+                "UPDATE backends SET calls = calls + 1 WHERE server = ?", (server,)
+            )
+            con.execute(
+                "INSERT INTO backend_calls (server, owner, expires) VALUES (?, ?, ?)",
+                (server, os.getpid(), now + self.timeout),
+            )
+            if exclude:
+                con.execute("UPDATE hedging SET hedged = hedged + 1")
+        return server
+
+    def finish(self, server: str, latency: float, ok: bool | None, hedge=False):
+        """Records a call (`ok=None` for outcomes that say nothing about health).
+
+        Args:
+            server: Server returned by `pick`.
+            latency: Seconds the call took.
+            ok: Whether the server responded normally.
+            hedge: Whether the call was a hedge (counted in `hedge_wins` if it
+                succeeds before being cancelled).
+        """
+        with transaction(self.file) as con:
+            con.execute(
+                """DELETE FROM backend_calls WHERE id = (
+                    SELECT id FROM backend_calls WHERE server = ? AND owner = ?
+                    LIMIT 1
+                )""",
+                (server, os.getpid()),
+            )
+            if ok is None:
+                return
+            if ok:
+                con.execute(
+                    "UPDATE backends SET failures = 0, down = 0 WHERE server = ?",
+                    (server,),
+                )
+                last = con.execute(
+                    "INSERT INTO backend_latencies (latency) VALUES (?)", (latency,)
+                ).lastrowid
+                con.execute(
+                    "DELETE FROM backend_latencies WHERE id <= ?", (last - self.window,)
+                )
+                if hedge:
+                    con.execute("UPDATE hedging SET wins = wins + 1")
+                return
+            con.execute(
+                "UPDATE backends SET failures = failures + 1 WHERE server = ?",
+                (server,),
+            )
+            con.execute(
+                "UPDATE backends SET down = ? WHERE server = ? AND failures >= ?",
+                (time.time() + self.recheck, server, self.threshold),
+            )
+
+    def hedge_delay(self) -> float | None:
+        """Returns the `hedge` latency percentile, or `None` without enough data."""
+        if not self.hedge:
+            return None
+        with transaction(self.file) as con:
+            latencies = [
+                x[0]
+                for x in con.execute(
+                    "SELECT latency FROM backend_latencies ORDER BY latency"
+                )
+            ]
+        if len(latencies) < 20:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * self.hedge))]
+
+    def stats(self) -> dict:
+        delay = self.hedge_delay()
+        now = time.time()
+        with transaction(self.file) as con:
+            state = self._state(con, now)
+            hedged, wins = con.execute("SELECT hedged, wins FROM hedging").fetchone()
+        servers = self.servers + sum(self.routes.values(), [])
+        return {
+            "servers": {
+                s: {
+                    "healthy": state[s][3] <= now,
+                    "outstanding": state[s][0],
+                    "calls": state[s][1],
+                    "failures": state[s][2],
+                }
+                for s in dict.fromkeys(servers)
+                if s in state
+            },
+            "hedge_delay": delay,
+            "hedged": hedged,
+            "hedge_wins": wins,
+        }
+
+    def __init__(
+        self,
+        file: str,
+        servers: list[str],
+        threshold: int = 2,
+        recheck: float = 10,
+        hedge: float = 95,
+        window: int = 200,
+        timeout: float = 300,
+    ):
+        self.file = Path(file)
+        self.servers = [default_servers.get(s, s) for s in servers]
+        self.threshold = threshold
+        self.recheck = recheck
+        self.hedge = hedge / 100
+        self.window = window
+        self.timeout = timeout
+        self.routes = {}
+        self.file.parent.mkdir(parents=True, exist_ok=True)
+        con = sqlite3.connect(self.file, timeout=30)
+        try:
+            con.execute("PRAGMA journal_mode=WAL")
+            for statement in self.schema:
+                con.execute(statement)
+            self._add(con, self.servers)
+            con.execute("INSERT OR IGNORE INTO hedging VALUES (0, 0, 0)")
+            con.commit()
+        finally:
+            con.close()
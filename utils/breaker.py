@@ -0,0 +1,111 @@
+# Copyright (c) 2023 Loryn Isaacs
+# This file is part of Quartz, licensed under GPL3+ https://github.com/engisalor/quartz
+"""A circuit breaker for API calls shared by app workers."""
+import sqlite3
+import time
+from pathlib import Path
+
+from utils.cache import transaction
+
+
+class CircuitOpen(Exception):
+    """Raised for calls not sent because the server is failing."""
+
+
+class CircuitBreaker:
+    """Stops sending calls after consecutive failures, stored in SQLite.
+
+    Args:
+        file: Database path (shared by all workers and threads).
+        threshold: Consecutive failures (connection errors, timeouts, 429/5xx)
+            that open the circuit.
+        cooldown: Seconds before a call is let through to test the server.
+
+    Methods:
+        allow: Whether a call can be sent now.
+        record: Records the outcome of a call.
+        is_open: Whether calls are being refused (without using up a test call).
+        is_closed: Whether the server is considered healthy (not testing it).
+        stats: Returns the circuit state.
+
+    Notes:
+        While open, calls fail at once with `CircuitOpen` instead of waiting for
+        the server. After `cooldown` one call is let through (half-open): if it
+        succeeds the circuit closes, otherwise it opens again. Timeouts count
+        as failures here, but unlike other failures they aren't retried or
+        used to reduce concurrency (see `RateLimiter`).
+    """
+
+    schema = [
+        """CREATE TABLE IF NOT EXISTS breaker (
+            id INTEGER PRIMARY KEY CHECK (id = 0),
+            failures INTEGER NOT NULL,
+            opened REAL,
+            probe REAL
+        )""",
+    ]
+
+    def allow(self) -> bool:
+        now = time.time()
+        with transaction(self.file) as con:
+            failures, opened, probe = con.execute(
+                "SELECT failures, opened, probe FROM breaker"
+            ).fetchone()
+            if opened is None:
+                return True
+            if now - opened < self.cooldown or (probe and probe > now):
+                return False
+            con.execute("UPDATE breaker SET probe = ?", (now + self.cooldown,))
+            return True
+
+    def record(self, ok: bool):
+        """Closes the circuit after a success or counts a failure."""
+        with transaction(self.file) as con:
+            if ok:
+                con.execute("UPDATE breaker SET failures = 0, opened = NULL")
+                return
+            failures, opened = con.execute(
+                "SELECT failures, opened FROM breaker"
+            ).fetchone()
+            failures += 1
+            if failures >= self.threshold or opened is not None:
+                opened = time.time()
+            con.execute(
+                "UPDATE breaker SET failures = ?, opened = ?, probe = NULL",
+                (failures, opened),
+            )
+
+    def is_open(self) -> bool:
+        with transaction(self.file) as con:
+            opened, probe = con.execute("SELECT opened, probe FROM breaker").fetchone()
+        now = time.time()
+        return opened is not None and (
+            now - opened < self.cooldown or bool(probe and probe > now)
+        )
+
+    def is_closed(self) -> bool:
+        with transaction(self.file) as con:
+            opened = con.execute("SELECT opened FROM breaker").fetchone()[0]
+        return opened is None
+
+    def stats(self) -> dict:
+        with transaction(self.file) as con:
+            failures, opened = con.execute(
+                "SELECT failures, opened FROM breaker"
+            ).fetchone()
+        return {"open": self.is_open(), "failures": failures, "opened": opened}
+
+    def __init__(self, file: str, threshold: int = 5, cooldown: float = 30):
+        self.file = Path(file)
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.file.parent.mkdir(parents=True, exist_ok=True)
+        con = sqlite3.connect(self.file, timeout=30)
+        try:
+            con.execute("PRAGMA journal_mode=WAL")
+            for statement in self.schema:
+                con.execute(statement)
+            con.execute("INSERT OR IGNORE INTO breaker VALUES (0, 0, NULL, NULL)")
+            con.commit()
+        finally:
+            con.close()
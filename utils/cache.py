@@ -0,0 +1,401 @@
+# Copyright (c) 2023 Loryn Isaacs
+# This file is part of Quartz, licensed under GPL3+ https://github.com/engisalor/quartz
+"""Persistent cache for API results shared by app workers."""
+import contextlib
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+
+def make_key(*items: str) -> str:
+    """Returns a hash for a sequence of strings (e.g., normalized call params)."""
+    return hashlib.blake2b("\x1f".join(items).encode()).hexdigest()[0:32]
+
+
+@contextlib.contextmanager
+def transaction(file: Path):
+    """Yields a connection in a write transaction that commits on exit."""
+    con = sqlite3.connect(file, timeout=30, isolation_level=None)
+    try:
+        con.execute("BEGIN IMMEDIATE")
+        yield con
+        con.execute("COMMIT")
+    except BaseException:
+        con.execute("ROLLBACK")
+        raise
+    finally:
+        con.close()
+
+
+def alive(pid: int) -> bool:
+    """Whether a process is running on this host."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class BlobFile(io.RawIOBase):
+    """A read-only file over a value stored in SQLite, read incrementally.
+
+    Notes:
+        The value is read in a transaction of its own connection, so it stays
+        the same even if the entry is replaced or evicted meanwhile. Close the
+        file to end the transaction. Readers such as `pyarrow` may use the file
+        from other threads.
+    """
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        with self._lock:
+            data = self._blob.read(len(b))
+        b[: len(data)] = data
+        return len(data)
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        with self._lock:
+            self._blob.seek(offset, whence)
+            return self._blob.tell()
+
+    def tell(self) -> int:
+        with self._lock:
+            return self._blob.tell()
+
+    def close(self):
+        with self._lock:
+            if not self.closed:
+                self._blob.close()
+                self._con.close()
+            super().close()
+
+    def __init__(self, con: sqlite3.Connection, blob: sqlite3.Blob):
+        self._con = con
+        self._blob = blob
+        self._lock = threading.Lock()
+
+
+class ResultCache:
+    """A size-bounded LRU cache with a time-to-live, stored in SQLite.
+
+    Args:
+        file: Database path (shared by all workers and threads).
+        max_mb: Size limit for stored values before evicting least recently used.
+        ttl: Seconds before an entry expires.
+
+    Methods:
+        get: Returns a value or `None` if missing or expired.
+        open: Returns a value as a `BlobFile` (like `get` without loading it).
+        set: Stores a value and evicts entries beyond `max_mb`.
+        __contains__: Whether a key is stored and fresh (without counting a hit).
+        stale: Returns a value even if expired (e.g. when the server is down).
+        take_stale: Returns params of stale entries worth fetching again.
+        claim: Leases keys to a process that will fetch their values.
+        release: Ends leases held by a process.
+        is_claimed: Whether a key is leased to a running process.
+        incr: Increments a counter.
+        stats: Returns hit/miss counters and cache size.
+        clear: Deletes all entries and counters.
+
+    Notes:
+        Leases are held by process ID, so workers sharing the file must run on
+        the same host (as with any SQLite file). A lease ends when released,
+        when it expires or when its process exits. Expired entries stay until
+        evicted so they can be served as stale results.
+
+        Values stored with `prefetched=True` are counted as `prefetched` and the
+        first `get` of each as a `prefetch_hits`, which gives the share of
+        speculative fetches that were used. Lookups with `prefetch=True` aren't
+        counted at all.
+    """
+
+    schema = [
+        """CREATE TABLE IF NOT EXISTS results (
+            key TEXT PRIMARY KEY,
+            value BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            created REAL NOT NULL,
+            accessed REAL NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)",
+        """CREATE TABLE IF NOT EXISTS counters (
+            name TEXT PRIMARY KEY,
+            n INTEGER NOT NULL
+        )""",
+        """CREATE TABLE IF NOT EXISTS inflight (
+            key TEXT PRIMARY KEY,
+            owner INTEGER NOT NULL,
+            expires REAL NOT NULL
+        )""",
+        "CREATE TABLE IF NOT EXISTS prefetched (key TEXT PRIMARY KEY)",
+        """CREATE TABLE IF NOT EXISTS stale (
+            key TEXT PRIMARY KEY,
+            params TEXT NOT NULL,
+            hits INTEGER NOT NULL
+        )""",
+    ]
+
+    def connect(self):
+        """Returns a transaction that commits on exit (one per operation)."""
+        return transaction(self.file)
+
+    @staticmethod
+    def _count(con: sqlite3.Connection, name: str, n: int = 1):
+        con.execute(
+            "INSERT INTO counters VALUES (?, ?) "
+            "ON CONFLICT (name) DO UPDATE SET n = n + excluded.n",
+            (name, n),
+        )
+
+    def get(self, key: str, prefetch: bool = False) -> bytes | None:
+        now = time.time()
+        with self.connect() as con:
+            row = con.execute(
+                "SELECT value, created FROM results WHERE key = ?", (key,)
+            ).fetchone()
+            if row and now - row[1] > self.ttl:
+                # expired entries are kept (until evicted) to serve when stale
+                self._count(con, "expired")
+                row = None
+            if prefetch:
+                return row[0] if row else None
+            if not row:
+                self._count(con, "misses")
+                return None
+            con.execute("UPDATE results SET accessed = ? WHERE key = ?", (now, key))
+            self._count(con, "hits")
+            if con.execute("DELETE FROM prefetched WHERE key = ?", (key,)).rowcount:
+                self._count(con, "prefetch_hits")
+            return row[0]
+
+    def open(self, key: str) -> BlobFile | None:
+        con = sqlite3.connect(
+            self.file, timeout=30, isolation_level=None, check_same_thread=False
+        )
+        try:
+            # a read transaction keeps the value as it is now until closed
+            con.execute("BEGIN")
+            row = con.execute(
+                "SELECT rowid, created FROM results WHERE key = ?", (key,)
+            ).fetchone()
+            fresh = bool(row) and time.time() - row[1] <= self.ttl
+            if fresh:
+                blob = con.blobopen("results", "value", row[0], readonly=True)
+        except BaseException:
+            con.close()
+            raise
+        with self.connect() as _con:
+            if not fresh:
+                self._count(_con, "expired" if row else "misses")
+                con.close()
+                return None
+            _con.execute(
+                "UPDATE results SET accessed = ? WHERE key = ?", (time.time(), key)
+            )
+            self._count(_con, "hits")
+        return BlobFile(con, blob)
+
+    def set(self, key: str, value: bytes | str, prefetched: bool = False):
+        if isinstance(value, str):
+            value = value.encode()
+        now = time.time()
+        with self.connect() as con:
+            con.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+                (key, value, len(value), now, now),
+            )
+            con.execute("DELETE FROM stale WHERE key = ?", (key,))
+            if prefetched:
+                con.execute("INSERT OR IGNORE INTO prefetched VALUES (?)", (key,))
+                self._count(con, "prefetched")
+            else:
+                con.execute("DELETE FROM prefetched WHERE key = ?", (key,))
+            evicted = con.execute(
+                """DELETE FROM results WHERE key IN (
+                    SELECT key FROM (
+                        SELECT key, SUM(size) OVER (
+                            ORDER BY accessed DESC ROWS UNBOUNDED PRECEDING
+                        ) AS running FROM results
+                    ) WHERE running > ?
+                )""",
+                (self.max_bytes,),
+            ).rowcount
+            if evicted:
+                self._count(con, "evicted", evicted)
+                con.execute(
+                    "DELETE FROM prefetched WHERE key NOT IN (SELECT key FROM results)"
+                )
+
+    def __contains__(self, key: str) -> bool:
+        with self.connect() as con:
+            row = con.execute(
+                "SELECT created FROM results WHERE key = ?", (key,)
+            ).fetchone()
+        return bool(row) and time.time() - row[0] <= self.ttl
+
+    def stale(self, key: str, params: dict) -> tuple[bytes, float] | None:
+        """Returns a value regardless of age and when it was stored, if any.
+
+        The lookup is counted for the key so `take_stale` can refresh the
+        most requested stale entries.
+        """
+        with self.connect() as con:
+            row = con.execute(
+                "SELECT value, created FROM results WHERE key = ?", (key,)
+            ).fetchone()
+            if row:
+                con.execute(
+                    "INSERT INTO stale VALUES (?, ?, 1) "
+                    "ON CONFLICT (key) DO UPDATE SET hits = hits + 1",
+                    (key, json.dumps(params)),
+                )
+                self._count(con, "stale_hits")
+        return row
+
+    def take_stale(self, n: int) -> list[dict]:
+        """Returns params of the `n` most requested stale entries (until `set`)."""
+        with self.connect() as con:
+            con.execute("DELETE FROM stale WHERE key NOT IN (SELECT key FROM results)")
+            rows = con.execute(
+                "SELECT params FROM stale ORDER BY hits DESC LIMIT ?", (n,)
+            ).fetchall()
+        return [json.loads(x[0]) for x in rows]
+
+    def claim(self, keys: list[str], owner: int, ttl: float) -> list[str]:
+        """Leases keys not already leased to another process and returns them."""
+        now = time.time()
+        claimed = []
+        with self.connect() as con:
+            for key in keys:
+                row = con.execute(
+                    "SELECT owner, expires FROM inflight WHERE key = ?", (key,)
+                ).fetchone()
+                if row and row[0] != owner and row[1] > now and alive(row[0]):
+                    continue
+                con.execute(
+                    "INSERT OR REPLACE INTO inflight VALUES (?, ?, ?)",
+                    (key, owner, now + ttl),
+                )
+                claimed.append(key)
+        return claimed
+
+    def release(self, keys: list[str], owner: int):
+        with self.connect() as con:
+            con.executemany(
+                "DELETE FROM inflight WHERE key = ? AND owner = ?",
+                [(key, owner) for key in keys],
+            )
+
+    def is_claimed(self, key: str) -> bool:
+        with self.connect() as con:
+            row = con.execute(
+                "SELECT owner, expires FROM inflight WHERE key = ?", (key,)
+            ).fetchone()
+        return bool(row) and row[1] > time.time() and alive(row[0])
+
+    def incr(self, name: str, n: int = 1):
+        with self.connect() as con:
+            self._count(con, name, n)
+
+    def stats(self) -> dict:
+        with self.connect() as con:
+            dt = dict(con.execute("SELECT name, n FROM counters").fetchall())
+            entries, size = con.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results"
+            ).fetchone()
+        names = ["hits", "misses", "expired", "evicted", "coalesced"]
+        names += ["prefetched", "prefetch_hits", "stale_hits"]
+        dt = {k: dt.get(k, 0) for k in names} | dt
+        rate = dt["prefetch_hits"] / dt["prefetched"] if dt["prefetched"] else None
+        return dt | {"prefetch_hit_rate": rate, "entries": entries, "bytes": size}
+
+    def clear(self):
+        with self.connect() as con:
+            con.execute("DELETE FROM results")
+            con.execute("DELETE FROM counters")
+            con.execute("DELETE FROM inflight")
+            con.execute("DELETE FROM prefetched")
+            con.execute("DELETE FROM stale")
+
+    def __init__(self, file: str, max_mb: int = 256, ttl: int = 604800):
+        self.file = Path(file)
+        self.max_bytes = max_mb * 1024**2
+        self.ttl = ttl
+        self.file.parent.mkdir(parents=True, exist_ok=True)
+        con = sqlite3.connect(self.file, timeout=30)
+        try:
+            con.execute("PRAGMA journal_mode=WAL")
+            for statement in self.schema:
+                con.execute(statement)
+            con.commit()
+        finally:
+            con.close()
+
+
+class FrameStore:
+    """Stores DataFrames in a `ResultCache` as Parquet (e.g. raw query results).
+
+    Args:
+        cache: Where frames are stored (subject to the cache's LRU/TTL limits).
+        namespace: Included in keys (e.g. the server URL).
+        row_group_size: Rows per Parquet row group.
+
+    Methods:
+        key: Returns a key for JSON-serializable items (e.g. call params).
+        get: Returns a DataFrame or `None` if missing or expired.
+        reader: Returns a `ParquetFile` to read a frame in batches (or `None`).
+            The frame is read from the database as needed: close the reader
+            when done.
+        set: Stores a DataFrame.
+    """
+
+    def key(self, *items) -> str:
+        items = json.dumps(items, sort_keys=True, ensure_ascii=False)
+        return make_key("frame", self.namespace, items)
+
+    def get(self, key: str) -> pd.DataFrame | None:
+        value = self.cache.get(key)
+        if value is None:
+            return None
+        return pd.read_parquet(io.BytesIO(value))
+
+    def reader(self, key: str) -> pq.ParquetFile | None:
+        file = self.cache.open(key)
+        if file is None:
+            return None
+        try:
+            return pq.ParquetFile(file)
+        except BaseException:
+            file.close()
+            raise
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.cache
+
+    def set(self, key: str, df: pd.DataFrame):
+        buffer = io.BytesIO()
+        # row groups are the unit read at once by `reader`
+        df.to_parquet(buffer, row_group_size=self.row_group_size)
+        self.cache.set(key, buffer.getvalue())
+
+    def __init__(
+        self, cache: ResultCache, namespace: str = "", row_group_size: int = 65536
+    ):
+        self.cache = cache
+        self.namespace = namespace
+        self.row_group_size = row_group_size
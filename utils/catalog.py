@@ -0,0 +1,89 @@
+# Copyright (c) 2023 Loryn Isaacs
+# This file is part of Quartz, licensed under GPL3+ https://github.com/engisalor/quartz
+"""Lookup index for corpus names, colors and attributes."""
+import pandas as pd
+
+
+class Catalog:
+    """Immutable index of corpus metadata for constant-time lookups in callbacks.
+
+    Args:
+        dt: Corpora config (see `CORPORA_YML`).
+        structures: Structures of loaded corpora (see `settings.CorpData`).
+
+    Methods:
+        label: Returns the label of a corpus attribute (e.g. `doc.file` -> `file`).
+        attr: Returns the attribute for a corpus label (e.g. `file` -> `doc.file`).
+        attrs: Returns attributes for a label in a set of corpora.
+        attr_labels: Returns a corpus's non-excluded attributes and their labels.
+        labels: Returns labels usable for a set of corpora.
+        is_choropleth: Whether a label is drawn as a choropleth in a set of corpora.
+
+    Attributes:
+        names: Display names by corpus.
+        colors: Colors by display name.
+
+    Notes:
+        Label sets for combinations of corpora are memoized by `frozenset`.
+    """
+
+    def label(self, corpus: str, attr: str, default=None) -> str | None:
+        return self._labels.get(corpus, {}).get(attr, default)
+
+    def attr(self, corpus: str, label: str) -> str:
+        return self._attrs[corpus][label]
+
+    def attrs(self, corpora: list, label: str) -> list:
+        return [
+            self._attrs[c][label] for c in corpora if label in self._attrs.get(c, {})
+        ]
+
+    def attr_labels(self, corpus: str) -> dict:
+        return {
+            k: v
+            for k, v in self._labels.get(corpus, {}).items()
+            if v in self._usable.get(corpus, ())
+        }
+
+    def labels(self, corpora: list) -> tuple:
+        """Returns sorted labels available in every corpus (comparable if several)."""
+        key = frozenset(corpora)
+        if key not in self._memo:
+            sets = self._comparable if len(key) > 1 else self._usable
+            if key and all(c in sets for c in key):
+                self._memo[key] = tuple(
+                    sorted(frozenset.intersection(*[sets[c] for c in key]))
+                )
+            else:
+                self._memo[key] = ()
+        return self._memo[key]
+
+    def is_choropleth(self, corpora: list, label: str) -> bool:
+        return any(label in self._choropleth.get(c, ()) for c in corpora)
+
+    def __init__(self, dt: dict, structures: pd.DataFrame):
+        self.names = {k: v["name"] for k, v in dt.items()}
+        self.colors = {v["name"]: v["color"] for v in dt.values()}
+        self._labels = {k: dict(v.get("label", {})) for k, v in dt.items()}
+        self._usable = {}
+        self._comparable = {}
+        self._choropleth = {
+            k: frozenset(v.get("choropleth", [])) for k, v in dt.items()
+        }
+        self._memo = {}
+        for corpus, df in structures.groupby("corpus", sort=False):
+            if corpus not in dt:
+                continue
+            rows = list(zip(df["attr"], df["label"], df["exclude"], df["comparable"]))
+            self._labels[corpus] = {attr: label for attr, label, _, _ in rows}
+            self._usable[corpus] = frozenset(x[1] for x in rows if not x[2])
+            self._comparable[corpus] = frozenset(
+                x[1] for x in rows if not x[2] and x[3]
+            )
+            self._choropleth[corpus] = self._choropleth[corpus] | frozenset(
+                label for attr, label, _, _ in rows if attr in self._choropleth[corpus]
+            )
+        self._attrs = {
+            k: {label: attr for attr, label in v.items()}
+            for k, v in self._labels.items()
+        }
@@ -0,0 +1,61 @@
+# Copyright (c) 2023 Loryn Isaacs
+# This file is part of Quartz, licensed under GPL3+ https://github.com/engisalor/quartz
+"""Crossfilters sliced from multi-level frequency tables."""
+import pandas as pd
+
+from utils.api import Client
+from utils.freqstats import server_params
+
+
+def table_params(params: dict, crossfilter: str, max_items: int) -> dict:
+    """Returns Freqs params for an attribute × crossfilter table of a query.
+
+    Args:
+        params: Freqs params of the query (its `fcrit` is the first level).
+        crossfilter: Attribute path of the second level, e.g. `doc.year`.
+        max_items: Most cells to fetch.
+    """
+    params = {k: v for k, v in params.items() if k not in server_params}
+    return params | {
+        "fcrit": f'{params["fcrit"]} {crossfilter} 0',
+        "freq_sort": "frq",
+        "fmaxitems": max_items,
+        "fpage": 1,
+    }
+
+
+def table_from_json(_json: dict) -> pd.DataFrame:
+    """Returns the `value`, `crossvalue` and `frq` of each cell in a table."""
+    rows = [
+        (item["Word"][0]["n"], item["Word"][1]["n"], item["frq"])
+        for block in _json.get("Blocks", [])
+        for item in block.get("Items", [])
+        if len(item.get("Word", [])) == 2
+    ]
+    return pd.DataFrame(rows, columns=["value", "crossvalue", "frq"])
+
+
+def fetch_tables(
+    client: Client, params: list[dict], max_items: int, progress=None
+) -> list[pd.DataFrame | None]:
+    """Gets tables for `table_params`, with `None` for failed or incomplete ones.
+
+    Notes:
+        A table with `max_items` cells may be missing some, so its crossfilters
+        have to be fetched one by one instead.
+    """
+    data, errors = client.run(params, progress)
+    failed = {e[2] for e in errors}
+    tables = []
+    for x, call in enumerate(data.freqs):
+        table = None if x in failed else table_from_json(call.response.json())
+        if table is not None and len(table) >= max_items:
+            table = None
+        tables.append(table)
+    return tables
+
+
+def cells(table: pd.DataFrame, value: str) -> pd.DataFrame:
+    """Returns crossfilter frequencies within a value like a restricted Freqs call."""
+    df = table.loc[table["value"] == value, ["crossvalue", "frq"]]
+    return df.rename(columns={"crossvalue": "value"}).reset_index(drop=True)
@@ -1,4 +1,5 @@
 """Functions for converting data types and shapes."""
+import numpy as np
 import pandas as pd
 
 
@@ -36,3 +37,47 @@ def multivalue_to_unique(items: list, separator="|"):
     unnested = [v for ls in nested for v in ls if v]
     ls.extend(unnested)
     return sorted(list(set(ls)))
+
+
+def melt_rows(
+    df: pd.DataFrame,
+    filters: dict[str, list],
+    id_vars: list[str],
+    value_vars: list[str],
+    var_name: str,
+    value_name: str,
+    sort: str,
+) -> pd.DataFrame:
+    """Melts columns of the rows matching filters, sorted by a column.
+
+    Args:
+        df: Data in wide format.
+        filters: Values to keep by column (rows must match all filters).
+        id_vars: Columns to keep as they are.
+        value_vars: Columns to unpivot (others are dropped).
+        var_name: Name of the column with `value_vars` names (categorical, in
+            `value_vars` order).
+        value_name: Name of the column with `value_vars` values (floats).
+        sort: Column to sort by (stable, then by `value_vars` order).
+
+    Notes:
+        Same as filtering with `df.query`, melting and sorting, but only the
+        selected rows and columns are reshaped (the full frame isn't copied).
+    """
+    rows = np.arange(len(df))
+    for column, values in filters.items():
+        # each filter only checks rows left by the previous ones
+        data = df[column] if len(rows) == len(df) else df[column].take(rows)
+        rows = rows[data.isin(values).to_numpy()]
+    codes = pd.factorize(df[sort].to_numpy()[rows], sort=True)[0]
+    order = np.argsort(np.tile(codes, len(value_vars)), kind="stable")
+    melted = df[id_vars].take(np.tile(rows, len(value_vars))[order])
+    melted.index = pd.RangeIndex(len(melted))
+    melted[var_name] = pd.Categorical.from_codes(
+        np.repeat(np.arange(len(value_vars)), len(rows))[order], value_vars
+    )
+    melted[value_name] = np.concatenate(
+        [df[c].to_numpy()[rows].astype(np.float64) for c in value_vars]
+        or [np.empty(0, dtype=np.float64)]
+    )[order]
+    return melted
@@ -0,0 +1,126 @@
+# Copyright (c) 2023 Loryn Isaacs
+# This file is part of Quartz, licensed under GPL3+ https://github.com/engisalor/quartz
+"""Decoding the responses of many API calls into one DataFrame."""
+import itertools
+import json
+
+import numpy as np
+import pandas as pd
+
+try:
+    import orjson
+
+    loads = orjson.loads
+except ImportError:  # optional, parses JSON several times faster
+    loads = json.loads
+
+# item fields kept by `Freqs.df_from_json`
+freqs_fields = ["frq", "rel", "fpm", "reltt"]
+
+
+def _fields(items: list[list[dict]], fields: list[str] | None = None) -> list[str]:
+    """Returns fields in order of appearance in the first item of each list."""
+    seen = {}
+    for _items in items:
+        if _items:
+            seen |= dict.fromkeys(k for k in _items[0] if not fields or k in fields)
+    return list(seen)
+
+
+def _numbers(items: list[list[dict]], field: str, n: int) -> np.ndarray:
+    """Returns a field of all items as a single array (int64 for counts)."""
+    values = np.fromiter(
+        (i.get(field, np.nan) for i in itertools.chain.from_iterable(items)),
+        dtype=np.float64,
+        count=n,
+    )
+    ints = all(type(x[0].get(field)) is int for x in items if x)
+    if ints and not np.isnan(values).any() and (values == np.floor(values)).all():
+        return values.astype(np.int64)
+    return values
+
+
+def _repeat(values: list, counts: list[int]) -> np.ndarray:
+    """Returns a value of each response for each of its items (with its dtype)."""
+    return np.repeat(pd.Series(values).to_numpy(), counts)
+
+
+def freqs_frame(
+    texts: list[str], columns: dict[str, list] | None = None
+) -> pd.DataFrame:
+    """Returns a frame of Freqs responses, like concatenated `Freqs.df_from_json`.
+
+    Args:
+        texts: JSON responses.
+        columns: A value for each response to add as a column (e.g. `query`).
+
+    Notes:
+        Responses are parsed with `orjson` if available. Each column is filled
+        from all responses at once instead of building a frame per response.
+    """
+    blocks, counts, docs = [], [], []
+    for text in texts:
+        _json = loads(text)
+        _blocks = [b for b in _json.get("Blocks", []) if b.get("Head")]
+        blocks += [(b["Head"][0].get("id"), b.get("Items", [])) for b in _blocks]
+        counts.append(sum(len(b.get("Items", [])) for b in _blocks))
+        docs.append(_json)
+    n = sum(counts)
+    if not n:
+        return pd.DataFrame()
+    items = [b[1] for b in blocks]
+    data = {k: _numbers(items, k, n) for k in _fields(items, freqs_fields)}
+    data["value"] = [
+        "|".join(w["n"] for w in i["Word"]) for i in itertools.chain(*items)
+    ]
+    data["attribute"] = np.repeat([b[0] for b in blocks], [len(i) for i in items])
+    descs = [(d.get("Desc") or [{}])[0] for d in docs]
+    requests = [d.get("request", {}) for d in docs]
+    for k, v in {
+        "arg": [d.get("arg") for d in descs],
+        "nicearg": [d.get("nicearg") for d in descs],
+        "corpname": [r.get("corpname") for r in requests],
+        "total_fpm": [d.get("rel") for d in descs],
+        "total_frq": [d.get("size") for d in descs],
+        "fmaxitems": [r.get("fmaxitems") for r in requests],
+    }.items():
+        data[k] = _repeat(v, counts)
+    for k, v in (columns or {}).items():
+        data[k] = _repeat(v, counts)
+    return pd.DataFrame(data)
+
+
+def wordlist_frame(
+    texts: list[str], columns: dict[str, list] | None = None
+) -> pd.DataFrame:
+    """Returns a frame of Wordlist responses, like `Wordlist.df_from_json`.
+
+    Args:
+        texts: JSON responses.
+        columns: A value for each response to add as a column (e.g. `corpus`).
+
+    Notes:
+        Items are sorted by `frq` within each response and floats are rounded to
+        two decimals.
+    """
+    docs = [loads(text) for text in texts]
+    items = [d.get("Items") or [] for d in docs]
+    counts = [len(i) for i in items]
+    n = sum(counts)
+    if not n:
+        return pd.DataFrame()
+    data = {}
+    for k in _fields(items):
+        first = next(i[0][k] for i in items if i and k in i[0])
+        if isinstance(first, (int, float)):
+            data[k] = _numbers(items, k, n)
+        else:
+            data[k] = [i.get(k) for i in itertools.chain(*items)]
+    data["attribute"] = _repeat(
+        [d.get("request", {}).get("wlattr") for d in docs], counts
+    )
+    for k, v in (columns or {}).items():
+        data[k] = _repeat(v, counts)
+    df = pd.DataFrame(data).round(2)
+    order = np.lexsort((-df["frq"].to_numpy(), np.repeat(np.arange(len(docs)), counts)))
+    return df.iloc[order].reset_index(drop=True)
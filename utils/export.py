@@ -0,0 +1,84 @@
+# Copyright (c) 2023 Loryn Isaacs
+# This file is part of Quartz, licensed under GPL3+ https://github.com/engisalor/quartz
+"""Streaming file exports for DataFrames produced in batches."""
+import io
+from collections.abc import Iterable, Iterator
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+formats = {
+    "csv": {"label": "CSV", "mimetype": "text/csv"},
+    "parquet": {"label": "Parquet", "mimetype": "application/vnd.apache.parquet"},
+    "arrow": {"label": "Arrow", "mimetype": "application/vnd.apache.arrow.stream"},
+    "jsonl": {"label": "JSONL", "mimetype": "application/x-ndjson"},
+}
+
+
+class _Sink(io.RawIOBase):
+    """A write-only file that hands over its bytes after each chunk."""
+
+    def writable(self):
+        return True
+
+    def write(self, b) -> int:
+        b = bytes(b)
+        self._chunks.append(b)
+        self._size += len(b)
+        return len(b)
+
+    def tell(self) -> int:
+        return self._size
+
+    def take(self) -> bytes:
+        chunk = b"".join(self._chunks)
+        self._chunks = []
+        return chunk
+
+    def __init__(self):
+        self._chunks = []
+        self._size = 0
+
+
+def _stream_arrow(frames: Iterable[pd.DataFrame], writer) -> Iterator[bytes]:
+    sink = _Sink()
+    w, schema = None, None
+    for df in frames:
+        if w is None:
+            schema = pa.Schema.from_pandas(df, preserve_index=False)
+            w = writer(sink, schema)
+        w.write_table(pa.Table.from_pandas(df, schema=schema, preserve_index=False))
+        yield sink.take()
+    if w is not None:
+        w.close()
+        yield sink.take()
+
+
+def stream(frames: Iterable[pd.DataFrame], format: str) -> Iterator[bytes]:
+    """Yields a file in chunks, one per DataFrame (all with the same columns).
+
+    Args:
+        frames: Batches of rows (e.g. read from a `FrameStore`).
+        format: A key in `formats` (`csv`, `parquet`, `arrow` or `jsonl`).
+
+    Notes:
+        Parquet gets a row group per batch and Arrow an IPC stream message per
+        batch, so only one batch is serialized in memory at a time.
+    """
+    if format == "csv":
+        header = True
+        for df in frames:
+            yield df.to_csv(header=header).encode()
+            header = False
+    elif format == "jsonl":
+        for df in frames:
+            if not df.empty:
+                text = df.to_json(orient="records", lines=True, force_ascii=False)
+                yield (text.rstrip("\n") + "\n").encode()
+    elif format == "parquet":
+        yield from _stream_arrow(frames, pq.ParquetWriter)
+    elif format == "arrow":
+        yield from _stream_arrow(frames, pa.ipc.new_stream)
+    else:
+        raise ValueError(f"unsupported format {format}")
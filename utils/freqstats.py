@@ -0,0 +1,59 @@
+# Copyright (c) 2023 Loryn Isaacs
+# This file is part of Quartz, licensed under GPL3+ https://github.com/engisalor/quartz
+"""Frequency statistics derived locally from raw counts and corpus sizes."""
+import numpy as np
+import pandas as pd
+
+# Freqs params for statistics computed by the server
+server_params = {"showpoc": 1, "showreltt": 1, "showrel": 1}
+# decimals of statistics in Freqs responses
+decimals = {"fpm": 2, "reltt": 2, "rel": 1}
+
+
+def derive(
+    frq: np.ndarray, norm: np.ndarray, tokens: float, total_frq: np.ndarray
+) -> dict[str, np.ndarray]:
+    """Returns `fpm`, `reltt` and `rel` like Sketch Engine's Freqs calls.
+
+    Args:
+        frq: Occurrences in each text type.
+        norm: Size of each text type (tokens).
+        tokens: Size of the corpus (tokens).
+        total_frq: Occurrences in the whole corpus.
+
+    Notes:
+        Values are rounded as in server responses (see `decimals`); `rel` is
+        computed from unrounded values.
+    """
+    frq = np.asarray(frq, dtype=np.float64)
+    reltt = frq / np.asarray(norm, dtype=np.float64) * 1e6
+    total_fpm = np.asarray(total_frq, dtype=np.float64) / tokens * 1e6
+    stats = {
+        "fpm": frq / tokens * 1e6,
+        "reltt": reltt,
+        "rel": reltt / total_fpm * 100,
+    }
+    return {k: np.round(v, decimals[k]) for k, v in stats.items()}
+
+
+def add_stats(df: pd.DataFrame, norms: pd.Series, tokens: float | None):
+    """Adds statistics to a Freqs DataFrame with raw counts (e.g. `frq`).
+
+    Args:
+        df: Frequencies from `Freqs.df_from_json` for one corpus.
+        norms: Text type sizes indexed by value.
+        tokens: Corpus size.
+
+    Returns:
+        A copy of `df` with `fpm`, `reltt` and `rel`, or `None` if the corpus or
+        a text type has no known size (the server has to compute them).
+    """
+    if df.empty or not tokens:
+        return None
+    norm = df["value"].map(norms).to_numpy(dtype=np.float64, na_value=np.nan)
+    if np.isnan(norm).any() or (norm <= 0).any():
+        return None
+    df = df.copy()
+    for k, v in derive(df["frq"], norm, tokens, df["total_frq"]).items():
+        df[k] = v
+    return df
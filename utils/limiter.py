@@ -0,0 +1,203 @@
+# Copyright (c) 2023 Loryn Isaacs
+# This file is part of Quartz, licensed under GPL3+ https://github.com/engisalor/quartz
+"""Rate limiting for API calls shared by app workers."""
+import asyncio
+import os
+import sqlite3
+import time
+from pathlib import Path
+
+from utils.cache import alive, transaction
+
+
+def wait_limits(wait_dict: dict) -> tuple[float, int] | None:
+    """Returns a rate and burst matching SGEX's throttling rules.
+
+    SGEX waits `k` seconds between calls in jobs of up to `v` calls (`wait_dict`,
+    e.g. `{"0": 9, "0.5": 99, "4": 899, "45": None}`). The burst is the largest
+    job sent with the shortest positive wait and the rate follows the next wait,
+    e.g. 99 calls and then one every 4 seconds (900 per hour). Longer waits (the
+    daily limit) aren't enforced. Returns `None` if there are no positive waits.
+    """
+    tiers = sorted((float(k), v) for k, v in wait_dict.items() if float(k) > 0)
+    if not tiers:
+        return None
+    burst = tiers[0][1] or 1
+    wait = tiers[1][0] if len(tiers) > 1 else tiers[0][0]
+    return 1 / wait, burst
+
+
+class RateLimiter:
+    """A token bucket with adaptive concurrency, stored in SQLite.
+
+    Args:
+        file: Database path (shared by all workers and threads).
+        rate: Calls per second allowed for all workers combined.
+        burst: Calls that can start at once after an idle period.
+        max_concurrency: Upper limit for calls in flight.
+        min_concurrency: Lower limit for calls in flight.
+        tolerance: Latency over the baseline (ratio) treated as congestion.
+        timeout: Seconds before an unreleased permit is dropped.
+
+    Methods:
+        acquire: Waits for a token and a free slot and returns a permit.
+        try_acquire: Returns a permit if one is available now, else `None`.
+        release: Ends a permit and adapts concurrency to the call's outcome.
+        stats: Returns the current bucket state.
+
+    Notes:
+        Concurrency follows AIMD (additive increase, multiplicative decrease):
+        each healthy call raises the limit by `1 / limit` (about one slot per
+        round of calls), errors halve it and latency above `tolerance` times the
+        baseline (a slowly rising minimum, at least 100 ms) reduces it by 10%.
+        Permits of exited processes (e.g. cancelled jobs) are freed as with
+        `ResultCache` leases.
+
+        Low priority calls (e.g. prefetching) only start while the bucket is more
+        than half full and half the concurrency limit is free, so they use spare
+        capacity without delaying normal calls.
+    """
+
+    schema = [
+        """CREATE TABLE IF NOT EXISTS bucket (
+            id INTEGER PRIMARY KEY CHECK (id = 0),
+            tokens REAL NOT NULL,
+            updated REAL NOT NULL,
+            concurrency REAL NOT NULL,
+            latency REAL,
+            baseline REAL
+        )""",
+        """CREATE TABLE IF NOT EXISTS permits (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            owner INTEGER NOT NULL,
+            expires REAL NOT NULL
+        )""",
+    ]
+
+    def _clamp(self, concurrency: float) -> float:
+        return min(self.max_concurrency, max(self.min_concurrency, concurrency))
+
+    def _refill(self, con: sqlite3.Connection, now: float) -> tuple:
+        tokens, updated, concurrency = con.execute(
+            "SELECT tokens, updated, concurrency FROM bucket"
+        ).fetchone()
+        tokens = min(self.burst, tokens + max(now - updated, 0) * self.rate)
+        return tokens, self._clamp(concurrency)
+
+    def _active(self, con: sqlite3.Connection, now: float) -> int:
+        rows = con.execute("SELECT DISTINCT owner FROM permits").fetchall()
+        dead = [(x[0],) for x in rows if not alive(x[0])]
+        con.executemany("DELETE FROM permits WHERE owner = ?", dead)
+        con.execute("DELETE FROM permits WHERE expires < ?", (now,))
+        return con.execute("SELECT COUNT(*) FROM permits").fetchone()[0]
+
+    def _try_acquire(self, low: bool = False) -> tuple[int | None, float]:
+        """Returns a permit if available, else `None` and the tokens left."""
+        now = time.time()
+        with transaction(self.file) as con:
+            tokens, concurrency = self._refill(con, now)
+            active = self._active(con, now)
+            if low:
+                ready = tokens >= 1 + self.burst / 2
+                ready = ready and active < max(1, int(concurrency) // 2)
+            else:
+                ready = tokens >= 1 and active < int(concurrency)
+            con.execute(
+                "UPDATE bucket SET tokens = ?, updated = ?",
+                (tokens - 1 if ready else tokens, now),
+            )
+            if not ready:
+                return None, tokens
+            permit = con.execute(
+                "INSERT INTO permits (owner, expires) VALUES (?, ?)",
+                (os.getpid(), now + self.timeout),
+            ).lastrowid
+        return permit, tokens
+
+    async def acquire(self, priority: str = "normal") -> int:
+        low = priority == "low"
+        need = 1 + self.burst / 2 if low else 1
+        while True:
+            # database access runs in a thread to keep the event loop free
+            permit, tokens = await asyncio.to_thread(self._try_acquire, low)
+            if permit is not None:
+                return permit
+            delay = (need - tokens) / self.rate if tokens < need else 0.05
+            await asyncio.sleep(min(max(delay, 0.01), 1))
+
+    def try_acquire(self, priority: str = "normal") -> int | None:
+        return self._try_acquire(priority == "low")[0]
+
+    def release(self, permit: int, latency: float, ok: bool | None):
+        """Ends a permit (`ok=None` for outcomes that say nothing about load)."""
+        with transaction(self.file) as con:
+            con.execute("DELETE FROM permits WHERE id = ?", (permit,))
+            if ok is None:
+                return
+            concurrency, ewma, baseline = con.execute(
+                "SELECT concurrency, latency, baseline FROM bucket"
+            ).fetchone()
+            concurrency = self._clamp(concurrency)
+            if not ok:
+                concurrency /= 2
+            else:
+                ewma = latency if ewma is None else 0.8 * ewma + 0.2 * latency
+                if baseline is None:
+                    baseline = latency
+                baseline = min(latency, baseline + (ewma - baseline) * 0.01)
+                # sub-100 ms latencies are too noisy to signal congestion
+                if ewma > self.tolerance * max(baseline, 0.1):
+                    concurrency *= 0.9
+                else:
+                    concurrency += 1 / concurrency
+            con.execute(
+                "UPDATE bucket SET concurrency = ?, latency = ?, baseline = ?",
+                (self._clamp(concurrency), ewma, baseline),
+            )
+
+    def stats(self) -> dict:
+        now = time.time()
+        with transaction(self.file) as con:
+            tokens, concurrency = self._refill(con, now)
+            active = self._active(con, now)
+            latency, baseline = con.execute(
+                "SELECT latency, baseline FROM bucket"
+            ).fetchone()
+        return {
+            "tokens": tokens,
+            "concurrency": concurrency,
+            "active": active,
+            "latency": latency,
+            "baseline": baseline,
+        }
+
+    def __init__(
+        self,
+        file: str,
+        rate: float = 2,
+        burst: int = 10,
+        max_concurrency: int = 8,
+        min_concurrency: int = 1,
+        tolerance: float = 3,
+        timeout: float = 300,
+    ):
+        self.file = Path(file)
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.tolerance = tolerance
+        self.timeout = timeout
+        self.file.parent.mkdir(parents=True, exist_ok=True)
+        con = sqlite3.connect(self.file, timeout=30)
+        try:
+            con.execute("PRAGMA journal_mode=WAL")
+            for statement in self.schema:
+                con.execute(statement)
+            con.execute(
+                "INSERT OR IGNORE INTO bucket VALUES (0, ?, ?, ?, NULL, NULL)",
+                (burst, time.time(), self._clamp(max_concurrency / 2)),
+            )
+            con.commit()
+        finally:
+            con.close()
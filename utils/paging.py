@@ -0,0 +1,223 @@
+# Copyright (c) 2023 Loryn Isaacs
+# This file is part of Quartz, licensed under GPL3+ https://github.com/engisalor/quartz
+"""Fetching frequency pages in blocks that are paged and sorted locally."""
+import json
+
+import numpy as np
+import pandas as pd
+
+from utils import decode
+from utils.api import Client, make_call
+from utils.freqstats import server_params
+
+sorts = {"rel": "frq", "frq": "rel"}
+
+
+def block_params(params: dict, block: int) -> dict:
+    """Returns Freqs params for the block of `block` pages including a page."""
+    size = int(params["fmaxitems"])
+    page = int(params["fpage"])
+    return params | {"fmaxitems": size * block, "fpage": (page - 1) // block + 1}
+
+
+def is_complete(size: int, params: dict) -> bool:
+    """Whether a first page/block has every item (so any sort can be applied)."""
+    return int(params["fpage"]) == 1 and size < int(params["fmaxitems"])
+
+
+def page_slice(df: pd.DataFrame, params: list[dict], block: int) -> pd.DataFrame:
+    """Returns the rows of each page from its block, as if fetched by itself."""
+    if df.empty:
+        return df
+    call = df["call"].to_numpy()
+    size = np.array([int(p["fmaxitems"]) for p in params])
+    start = np.array([(int(p["fpage"]) - 1) % block for p in params]) * size
+    sorts = np.array([p.get("freq_sort", "rel") for p in params])
+    key = np.empty(len(df))
+    for sort in set(sorts):
+        rows = sorts[call] == sort
+        key[rows] = df[sort].to_numpy()[rows]
+    # stable like `sort_values`, descending within each call
+    order = np.lexsort((-key, call))
+    call = call[order]
+    rank = np.arange(len(call)) - np.searchsorted(call, call)
+    keep = order[(rank >= start[call]) & (rank < start[call] + size[call])]
+    df = df.iloc[keep].reset_index(drop=True)
+    df["fmaxitems"] = size.astype(str)[df["call"].to_numpy()]
+    return df
+
+
+def _decode(data, errors: list, calls: list[int], stale: dict) -> pd.DataFrame:
+    """Returns the rows of successful calls, with their index in `calls` as `call`."""
+    failed = {e[2] for e in errors}
+    done = [x for x in range(len(data.freqs)) if x not in failed]
+    for x in done:
+        if getattr(data.freqs[x].response, "cached_at", None):
+            stale[calls[x]] = data.freqs[x].response.cached_at
+    return decode.freqs_frame(
+        [data.freqs[x].response.text for x in done], {"call": [calls[x] for x in done]}
+    )
+
+
+def _refetch(client, calls, retry, df, errors, stale, progress, priority) -> tuple:
+    """Sends calls at indexes in `retry` again, replacing their rows and errors."""
+    data, _errors = client.run([calls[x] for x in retry], progress, priority)
+    errors = [e for e in errors if e[2] not in retry]
+    errors += [(e[0], e[1], retry[e[2]]) for e in _errors]
+    errors.sort(key=lambda e: e[2])
+    for x in retry:
+        stale.pop(x, None)
+    frames = [_decode(data, _errors, retry, stale)]
+    if not df.empty:
+        frames.insert(0, df.loc[~df["call"].isin(retry)])
+    frames = [f for f in frames if not f.empty]
+    if not frames:
+        return pd.DataFrame(), errors
+    df = pd.concat(frames, ignore_index=True)
+    return df.sort_values("call", kind="stable", ignore_index=True), errors
+
+
+def _sizes(df: pd.DataFrame, n: int) -> np.ndarray:
+    """Returns the number of rows of each call."""
+    if df.empty:
+        return np.zeros(n, dtype=int)
+    return np.bincount(df["call"], minlength=n)
+
+
+def fetch_frame(
+    client: Client,
+    params: list[dict],
+    block: int = 1,
+    progress=None,
+    priority: str = "normal",
+    derive=None,
+    columns: dict[str, list] | None = None,
+) -> tuple[pd.DataFrame, list]:
+    """Gets one DataFrame for Freqs calls, fetching pages in blocks if `block > 1`.
+
+    Args:
+        client: Sends calls (see `Client.run`).
+        params: Freqs call parameters, each with `fmaxitems`, `fpage` and
+            `freq_sort`.
+        block: Pages per call (e.g. 10 fetches pages 1-10 together).
+        progress: Passed to `Client.run`.
+        priority: Passed to `Client.run`.
+        derive: Adds statistics to a call's rows fetched without them, returning
+            `None` if it can't (see `CorpData.derive_stats`).
+        columns: A value for each call to add as a column (e.g. `query`).
+
+    Returns:
+        Rows of all calls in order, with `call` (index in `params`) and
+        `params` (of the requested page) columns, and errors like `Client.run`,
+        with indexes in `params`.
+
+    Notes:
+        Responses are decoded together (see `decode.freqs_frame`). Pages in a
+        block are served from the cache and sliced locally. Sorting by the other
+        frequency type is done locally too if a complete result (a first block
+        with fewer than `fmaxitems` items) is cached already. Calls without
+        `reltt` (lacking `server_params`) get statistics from `derive`, or are
+        fetched again with `server_params` if it fails. Calls with stale results
+        (see `Client.run`) are listed in `DataFrame.attrs["cached_at"]` with the
+        time they were fetched.
+    """
+    stale = {}
+    calls = list(params)
+    if block > 1:
+        calls = [block_params(p, block) for p in params]
+        for x, call in enumerate(calls):
+            other = call | {"freq_sort": sorts.get(call.get("freq_sort"), "rel")}
+            if other["fpage"] == 1 and client.is_cached(other):
+                calls[x] = other
+    data, errors = client.run(calls, progress, priority)
+    df = _decode(data, errors, range(len(calls)), stale)
+    if block > 1:
+        # results sorted differently and not complete have to be fetched
+        failed = {e[2] for e in errors}
+        sizes = _sizes(df, len(calls))
+        retry = [
+            x
+            for x, call in enumerate(calls)
+            if call["freq_sort"] != params[x].get("freq_sort")
+            and (x in failed or not is_complete(sizes[x], call))
+        ]
+        if retry:
+            for x in retry:
+                calls[x] = block_params(params[x], block)
+            df, errors = _refetch(
+                client, calls, retry, df, errors, stale, progress, priority
+            )
+    if derive and not df.empty:
+        for k in ["fpm", "reltt", "rel"]:
+            if k not in df.columns:
+                df[k] = np.nan
+        retry = []
+        for x in df.loc[df["reltt"].isna(), "call"].unique():
+            rows = df["call"] == x
+            derived = derive(df.loc[rows])
+            if derived is None:
+                retry.append(x)
+                continue
+            for k in ["fpm", "reltt", "rel"]:
+                df.loc[rows, k] = derived[k].to_numpy()
+        if retry:
+            calls = [
+                c | server_params if x in retry else c for x, c in enumerate(calls)
+            ]
+            df, errors = _refetch(
+                client, calls, retry, df, errors, stale, progress, priority
+            )
+    if block > 1:
+        df = page_slice(df, params, block)
+    if not df.empty:
+        call = df["call"].to_numpy()
+        labels = [json.dumps(make_call(p).params) for p in params]
+        for k, v in ({"params": labels} | (columns or {})).items():
+            df[k] = pd.Series(v).to_numpy()[call]
+    if stale:
+        df.attrs["cached_at"] = stale
+    return df, errors
+
+
+def split(df: pd.DataFrame, keys: list) -> dict:
+    """Splits a `fetch_frame` result by a key for each call (e.g. a graph).
+
+    Returns:
+        A frame without `call` for each unique key, with the time of its oldest
+        stale result as `DataFrame.attrs["cached_at"]`.
+    """
+    stale = df.attrs.get("cached_at", {})
+    groups = {}
+    for x, key in enumerate(keys):
+        groups.setdefault(key, []).append(x)
+    frames = {}
+    for key, xs in groups.items():
+        if df.empty:
+            frames[key] = pd.DataFrame()
+        else:
+            rows = df["call"].isin(xs)
+            frames[key] = df.loc[rows].drop(columns="call").reset_index(drop=True)
+        frames[key].attrs = {}
+        times = [stale[x] for x in xs if x in stale]
+        if times:
+            frames[key].attrs["cached_at"] = min(times)
+    return frames
+
+
+def fetch_pages(
+    client: Client,
+    params: list[dict],
+    block: int = 1,
+    progress=None,
+    priority: str = "normal",
+    derive=None,
+) -> tuple[list[pd.DataFrame], list]:
+    """Gets a DataFrame for each Freqs call (see `fetch_frame`)."""
+    df, errors = fetch_frame(client, params, block, progress, priority, derive)
+    return list(split(df, range(len(params))).values()), errors
+
+
+def cached_at(frames: list[pd.DataFrame]) -> float | None:
+    """Returns when the oldest stale result in frames was fetched (if any)."""
+    times = [df.attrs["cached_at"] for df in frames if "cached_at" in df.attrs]
+    return min(times) if times else None
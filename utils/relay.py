@@ -0,0 +1,168 @@
+# Copyright (c) 2023 Loryn Isaacs
+# This file is part of Quartz, licensed under GPL3+ https://github.com/engisalor/quartz
+"""Runs API calls of background jobs in the worker that forked them."""
+import atexit
+import logging
+import os
+import secrets
+import shutil
+import tempfile
+import threading
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Connection, Listener
+
+from dash import DiskcacheManager
+
+
+class Relay:
+    """Runs a function in a worker process for the jobs it forks.
+
+    Args:
+        func: Function to run in the worker, called with the arguments sent by a
+            job, an `on_done` callback whose calls are passed on to the job and
+            a `cancel` event (`None` when run locally).
+
+    Methods:
+        start: Listens for jobs in this process (before forking them).
+        attach: Sends calls of this forked process to the worker that forked it.
+        __call__: Runs `func` in the worker if attached, else in this process.
+
+    Notes:
+        Jobs forked by a worker can't use its HTTP session (see `Session`), so
+        without a relay each job opens new connections. The worker listens on a
+        Unix socket authenticated with a key its children inherit, serving each
+        connected job in a thread. Results must be picklable. When a job is
+        cancelled its process ends and its connection closes, which sets
+        `cancel` so the worker stops the job's calls too.
+    """
+
+    def _forget(self):
+        # a forked child can reach its parent's listener but doesn't serve it
+        self._upstream = getattr(self, "_address", None)
+        self._address = None
+        self._attached = False
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _serve(self, conn: Connection):
+        def on_done():
+            try:
+                conn.send(("done", None))
+            except OSError:
+                pass
+
+        def watch():
+            # a job sends nothing after its call, so its end only becomes
+            # readable when it closes (the job was cancelled)
+            while not finished.is_set():
+                try:
+                    if conn.poll(0.5):
+                        break
+                except (OSError, ValueError):
+                    break
+            if not finished.is_set():
+                cancel.set()
+
+        with conn:
+            try:
+                args, kwargs = conn.recv()
+            except (EOFError, OSError):
+                return
+            cancel, finished = threading.Event(), threading.Event()
+            threading.Thread(target=watch, name="relay", daemon=True).start()
+            try:
+                value = self.func(*args, on_done=on_done, cancel=cancel, **kwargs)
+                reply = ("result", value)
+            except Exception as err:
+                reply = ("error", err)
+            finally:
+                finished.set()
+            try:
+                conn.send(reply)
+            except OSError:
+                pass
+
+    def _accept(self, listener: Listener):
+        while True:
+            try:
+                conn = listener.accept()
+            except AuthenticationError:
+                continue
+            except OSError:
+                break
+            threading.Thread(
+                target=self._serve, args=(conn,), name="relay", daemon=True
+            ).start()
+
+    def start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            folder = tempfile.mkdtemp(prefix="quartz-relay-")
+            try:
+                listener = Listener(
+                    os.path.join(folder, "socket"), "AF_UNIX", authkey=self._authkey
+                )
+            except OSError as err:
+                shutil.rmtree(folder, ignore_errors=True)
+                logging.warning(f"jobs will send their own calls: {repr(err)}")
+                return
+            threading.Thread(
+                target=self._accept, args=(listener,), name="relay", daemon=True
+            ).start()
+            self._address = listener.address
+            self._pid = os.getpid()
+
+        def close():
+            if self._pid == os.getpid():
+                listener.close()
+                shutil.rmtree(folder, ignore_errors=True)
+
+        atexit.register(close)
+
+    def attach(self):
+        self._attached = bool(self._upstream)
+
+    def __call__(self, *args, on_done=None, **kwargs):
+        if not self._attached:
+            return self.func(*args, on_done=on_done, **kwargs)
+        with Client(self._upstream, "AF_UNIX", authkey=self._authkey) as conn:
+            conn.send((args, kwargs))
+            while True:
+                kind, value = conn.recv()
+                if kind == "done":
+                    if on_done:
+                        on_done()
+                elif kind == "error":
+                    raise value
+                else:
+                    return value
+
+    def __init__(self, func):
+        self.func = func
+        self._authkey = secrets.token_bytes(32)
+        self._forget()
+        os.register_at_fork(after_in_child=self._forget)
+
+
+class RelayManager(DiskcacheManager):
+    """A `DiskcacheManager` whose jobs run calls through a `Relay` of the worker.
+
+    Args:
+        cache: A `diskcache.Cache` for job results and progress.
+        relay: The relay jobs attach to.
+        kwargs: Passed to `DiskcacheManager`.
+    """
+
+    def call_job_fn(self, key, job_fn, args, context):
+        self.relay.start()
+
+        def run(*job_args):
+            self.relay.attach()
+            return job_fn(*job_args)
+
+        return super().call_job_fn(key, run, args, context)
+
+    def __init__(self, cache, relay: Relay, **kwargs):
+        super().__init__(cache, **kwargs)
+        self.relay = relay
@@ -0,0 +1,135 @@
+# Copyright (c) 2023 Loryn Isaacs
+# This file is part of Quartz, licensed under GPL3+ https://github.com/engisalor/quartz
+"""A persistent HTTP session for API calls, one per worker process."""
+import asyncio
+import atexit
+import concurrent.futures
+import os
+import threading
+from collections.abc import Awaitable, Callable
+
+import aiohttp
+
+
+class Timing:
+    """Timings for one request, recorded by `Session` trace hooks (seconds)."""
+
+    def __init__(self):
+        self.total = 0.0
+        self.connect = 0.0
+        self.queued = 0.0
+        self.reused = False
+        self._start = {}
+
+
+def _start(name: str):
+    async def hook(session, ctx, params):
+        if isinstance(ctx.trace_request_ctx, Timing):
+            ctx.trace_request_ctx._start[name] = asyncio.get_running_loop().time()
+
+    return hook
+
+
+def _end(name: str):
+    async def hook(session, ctx, params):
+        timing = ctx.trace_request_ctx
+        if isinstance(timing, Timing) and name in timing._start:
+            elapsed = asyncio.get_running_loop().time() - timing._start.pop(name)
+            setattr(timing, name, getattr(timing, name) + elapsed)
+
+    return hook
+
+
+async def _reused(session, ctx, params):
+    if isinstance(ctx.trace_request_ctx, Timing):
+        ctx.trace_request_ctx.reused = True
+
+
+class Session:
+    """An `aiohttp` session kept open in a background event loop.
+
+    Args:
+        limit: Size of the connection pool.
+        keepalive: Seconds to keep idle connections open for reuse.
+
+    Methods:
+        run: Runs a coroutine function with the session and returns its result
+            (cancelling it if a `cancel` event is set).
+        close: Closes the session (also done at exit).
+
+    Notes:
+        Responses are requested with gzip compression. Pass a `Timing` as
+        `trace_request_ctx` to a request to record how long it waited for a
+        connection (`queued`), spent opening one (`connect`: DNS, TCP and TLS)
+        and took in total. The session starts on first use and again in forked
+        processes, which can't share the parent's loop or connections.
+    """
+
+    def _trace(self) -> aiohttp.TraceConfig:
+        trace = aiohttp.TraceConfig()
+        trace.on_request_start.append(_start("total"))
+        trace.on_request_end.append(_end("total"))
+        trace.on_request_exception.append(_end("total"))
+        trace.on_connection_queued_start.append(_start("queued"))
+        trace.on_connection_queued_end.append(_end("queued"))
+        trace.on_connection_create_start.append(_start("connect"))
+        trace.on_connection_create_end.append(_end("connect"))
+        trace.on_connection_reuseconn.append(_reused)
+        return trace
+
+    async def _open(self) -> aiohttp.ClientSession:
+        return aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=self.limit, keepalive_timeout=self.keepalive
+            ),
+            headers={"Accept-Encoding": "gzip, deflate"},
+            raise_for_status=True,
+            trace_configs=[self._trace()],
+        )
+
+    def _forget(self):
+        # a forked child keeps the parent's session open (its connections are
+        # the parent's) but unused, and starts its own
+        self._inherited = getattr(self, "_session", None)
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def run(
+        self,
+        func: Callable[[aiohttp.ClientSession], Awaitable],
+        cancel: threading.Event | None = None,
+    ):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(
+                    target=self._loop.run_forever, name="session", daemon=True
+                ).start()
+                self._session = asyncio.run_coroutine_threadsafe(
+                    self._open(), self._loop
+                ).result()
+                self._pid = os.getpid()
+        future = asyncio.run_coroutine_threadsafe(func(self._session), self._loop)
+        while cancel is not None and not future.done():
+            concurrent.futures.wait([future], 0.5)
+            if cancel.is_set():
+                # cancels the coroutine's task in the loop
+                future.cancel()
+                break
+        return future.result()
+
+    def close(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                asyncio.run_coroutine_threadsafe(
+                    self._session.close(), self._loop
+                ).result(5)
+                self._loop.call_soon_threadsafe(self._loop.stop)
+                self._pid = None
+
+    def __init__(self, limit: int = 8, keepalive: float = 30):
+        self.limit = limit
+        self.keepalive = keepalive
+        self._forget()
+        os.register_at_fork(after_in_child=self._forget)
+        atexit.register(self.close)